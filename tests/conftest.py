@@ -0,0 +1,13 @@
+import pytest
+
+import world_render.world_textures.raster_cache as raster_cache
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    """A fresh RasterCache singleton in an empty directory"""
+    directory = str(tmp_path / 'cache')
+    monkeypatch.setattr(raster_cache, 'CACHE_DIR', directory)
+    monkeypatch.setattr(raster_cache.RasterCache, '_instance', None)
+    yield directory
+    monkeypatch.setattr(raster_cache.RasterCache, '_instance', None)
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+moderngl = pytest.importorskip('moderngl')
+pytest.importorskip('moderngl_window')
+
+from world_render import assets
+from world_render.cpu_compositor import NEAREST, CpuCompositor
+from world_render.geometrizer import CompactTileMesh, TileGeometryBuilder
+from world_render.texture_residency import TextureResidency
+from world_render.world_textures.texture_manager import WorldTextureManager, WorldTileIndex
+
+SIZE = 64
+
+
+@pytest.fixture
+def ctx():
+    try:
+        context = moderngl.create_standalone_context()
+    except Exception as e:
+        pytest.skip(f'no standalone GL context: {e}')
+    yield context
+    context.release()
+
+
+def test_atlas_path_matches_cpu_compositor(ctx):
+    manager = WorldTextureManager()
+    manager.tile_size = SIZE
+    tile = WorldTileIndex(manager, 5, 17, 11)
+    # every texel differs and the tile isn't symmetric in either axis, a mirrored sample can't match
+    raster = np.zeros((SIZE, SIZE, 4), dtype=np.uint8)
+    raster[..., 0] = np.arange(SIZE, dtype=np.uint8)[None, :] * 4
+    raster[..., 1] = np.arange(SIZE, dtype=np.uint8)[:, None] * 4
+    raster[..., 3] = 255
+
+    residency = TextureResidency(ctx, budget=SIZE * SIZE * 4 * 4, tile_size=SIZE, page_layers=4)
+    residency.upload(tile, raster)
+    residency.page(0).filter = (moderngl.NEAREST, moderngl.NEAREST)
+    builder = TileGeometryBuilder()
+    mesh, page_ranges = builder.remap_to_atlas(builder.tesselate_tiles_compact([tile]), residency.atlas)
+
+    # positions are 0..1, the upper right quadrant of clip space, rows of fbo.read() go up like grid y
+    fbo = ctx.simple_framebuffer((2 * SIZE, 2 * SIZE))
+    fbo.use()
+    fbo.clear()
+    prog = ctx.program(vertex_shader=assets.ATLAS_VERTEX_SHADER, fragment_shader=assets.ATLAS_FRAGMENT_SHADER)
+    vao = ctx.vertex_array(prog, [(ctx.buffer(mesh.vertices), CompactTileMesh.VERTEX_FORMAT, 'in_vert', 'in_tex', 'in_layer')],
+                           index_buffer=ctx.buffer(mesh.indices), index_element_size=4)
+    residency.use(0)
+    first, count = page_ranges[0].tolist()
+    vao.render(vertices=count, first=first)
+    gpu = np.frombuffer(fbo.read(components=3), dtype=np.uint8).reshape(2 * SIZE, 2 * SIZE, 3)[SIZE:, SIZE:]
+
+    cpu = CpuCompositor(manager, filter=NEAREST).composite_tiles(
+        [tile], tile.zoom, (tile.x, tile.y, tile.x + 1, tile.y + 1), (SIZE, SIZE), rasters={tile: raster})
+    assert np.array_equal(cpu[..., :3], raster[..., :3])
+    assert np.array_equal(gpu, cpu[..., :3])
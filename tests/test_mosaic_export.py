@@ -0,0 +1,38 @@
+import numpy as np
+from shapely.geometry import MultiPolygon, Polygon
+
+from world_render.mosaic_export import MosaicExporter
+from world_render.world_textures.texture_manager import WorldTextureManager
+from world_render.world_textures.tile_codec import encode_tile
+from world_render.world_textures.tile_sources import TileSource
+
+
+class _SolidSource(TileSource):
+    def __init__(self):
+        self.encoded = encode_tile(np.full((256, 256, 3), 200, dtype=np.uint8), 'PNG')
+        self.fetches = 0
+
+    def get_url(self, zoom: int, x: int, y: int) -> str:
+        return f'solid://{zoom}/{x}/{y}'
+
+    def fetch(self, zoom: int, x: int, y: int):
+        self.fetches += 1
+        return self.encoded
+
+
+def test_export_concave_area(cache_dir, tmp_path):
+    manager = WorldTextureManager()
+    manager.source = _SolidSource()
+    # a U with its arms to the south, the last row of windows only crosses the arms
+    area = Polygon([(34.0, 32.03), (34.03, 32.03), (34.03, 32.0), (34.02, 32.0), (34.02, 32.02),
+                    (34.01, 32.02), (34.01, 32.0), (34.0, 32.0)])
+    exporter = MosaicExporter(manager, area, 40, window=96, report=lambda stats: None)
+    parts = [exporter._window_area(*window)[1] for window in exporter.windows()]
+    assert any(isinstance(part, MultiPolygon) for part in parts)
+
+    stats = exporter.export(str(tmp_path / 'mosaic.npy'))
+    assert stats.windows == stats.total_windows
+    assert stats.tiles > 0 and manager.source.fetches > 0
+    out = np.load(tmp_path / 'mosaic.npy')
+    assert out.shape == (exporter.size[1], exporter.size[0], 4)
+    assert out[..., 3].any()
@@ -0,0 +1,35 @@
+import multiprocessing
+
+from world_render.world_textures import raster_cache
+from world_render.world_textures.raster_cache import _stress_worker
+from world_render.world_textures.tile_fetcher import BACKOFF_FACTOR, MAX_RETRIES, REQUEST_TIMEOUT
+
+TILES_PER_WORKER = 20
+FETCH_DELAY = 0.05
+WORKERS = 4
+
+
+def test_lock_outlives_slowest_fetch():
+    backoff = sum(BACKOFF_FACTOR * 2 ** attempt for attempt in range(MAX_RETRIES))
+    assert raster_cache.LOCK_EXPIRATION > (MAX_RETRIES + 1) * REQUEST_TIMEOUT + backoff
+
+
+def test_shared_keys_load_once(tmp_path):
+    keys = [('shared', i) for i in range(TILES_PER_WORKER)]
+    with multiprocessing.Pool(WORKERS) as pool:
+        loads, _ = zip(*pool.map(_stress_worker, [(str(tmp_path), keys, FETCH_DELAY)] * WORKERS))
+    assert sum(loads) == TILES_PER_WORKER
+
+
+def test_distinct_keys_scale_with_workers(tmp_path):
+    def run(workers, cache_dir):
+        jobs = [(str(cache_dir), [('distinct', worker, i) for i in range(TILES_PER_WORKER)], FETCH_DELAY)
+                for worker in range(workers)]
+        with multiprocessing.Pool(workers) as pool:
+            loads, elapsed = zip(*pool.map(_stress_worker, jobs))
+        assert sum(loads) == workers * TILES_PER_WORKER
+        return max(elapsed)
+
+    single = run(1, tmp_path / 'single')
+    # the fetches overlap, serialized they would take WORKERS times as long
+    assert run(WORKERS, tmp_path / 'many') < 2 * single
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from world_render.texture_residency import TILE_CHANNELS, TextureResidency, _FakeContext
+
+TILE_SIZE = 8
+
+
+@pytest.fixture
+def residency():
+    return TextureResidency(_FakeContext(), budget=TILE_SIZE * TILE_SIZE * TILE_CHANNELS * 4,
+                            tile_size=TILE_SIZE, page_layers=4)
+
+
+def _raster(channels=3):
+    return np.zeros((TILE_SIZE, TILE_SIZE, channels), dtype=np.uint8)
+
+
+def test_make_resident_uploads_loaded_tiles(residency):
+    uploaded = residency.make_resident(['a', 'b'], lambda tiles: [(tile, _raster()) for tile in tiles])
+    assert uploaded == ['a', 'b']
+    assert 'a' in residency.atlas and 'b' in residency.atlas
+    assert residency.uploads == 2
+    # resident tiles aren't loaded again
+    assert residency.make_resident(['a', 'b'], lambda tiles: [(tile, _raster()) for tile in tiles]) == []
+
+
+def test_failed_loads_release_their_slots(residency):
+    def load(tiles):
+        for tile in tiles:
+            if tile == 'a':
+                yield tile, _raster(4)
+            elif tile == 'b':
+                yield tile, None
+            # 'c' is never returned
+    uploaded = residency.make_resident(['a', 'b', 'c'], load)
+    assert uploaded == ['a']
+    assert 'a' in residency.atlas
+    assert 'b' not in residency.atlas and 'c' not in residency.atlas
+    assert len(residency.atlas) == 1 and residency.uploads == 1
+    # the failed tiles are retried by the next call
+    assert residency.make_resident(['a', 'b', 'c'], lambda tiles: [(tile, _raster()) for tile in tiles]) == ['b', 'c']
+
+
+def test_upload_ignores_missing_raster(residency):
+    residency.upload('a', None)
+    assert 'a' not in residency.atlas and residency.uploads == 0
+
+
+def test_write_rejects_mismatched_raster(residency):
+    with pytest.raises(AssertionError):
+        residency.upload('a', np.zeros((TILE_SIZE * 2, TILE_SIZE * 2, 3), dtype=np.uint8))
+    with pytest.raises(AssertionError):
+        residency.upload('b', np.zeros((TILE_SIZE, TILE_SIZE, 3), dtype=np.float32))
@@ -46,3 +46,31 @@ FRAGMENT_SHADER = '''
         f_color = vec4(texture(Texture, vec2(1 - v_color.x,  v_color.y)).rgb, 1.0);
     }
     '''
+
+ATLAS_VERTEX_SHADER = '''
+    #version 330
+
+    in vec2 in_vert;
+    in vec2 in_tex;
+    in float in_layer;
+
+    out vec3 v_tex;    // texcoords and the layer in the atlas page
+
+    void main() {
+        gl_Position = vec4(in_vert.x, in_vert.y, 0.0, 1.0);
+        v_tex = vec3(in_tex, in_layer);
+    }
+'''
+ATLAS_FRAGMENT_SHADER = '''
+    #version 330
+
+    uniform sampler2DArray Texture;
+
+    in vec3 v_tex;
+    out vec4 f_color;
+
+    void main() {
+        // meshes store u flipped, as sampled by FRAGMENT_SHADER and the cpu compositor
+        f_color = vec4(texture(Texture, vec3(1.0 - v_tex.x, v_tex.y, v_tex.z)).rgb, 1.0);
+    }
+    '''
@@ -0,0 +1,129 @@
+import dataclasses
+import itertools
+import numbers
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+import numpy as np
+from shapely.geometry import Polygon
+
+from world_render.geometrizer import CompactTileMesh, TileGeometryBuilder
+from world_render.world_textures.texture_manager import WorldTextureManager, WorldTextureQuerier, WorldTileIndex
+
+BATCH_PROCESSES = os.cpu_count() or 4
+BATCH_CHUNK = 64  # rois per task, amortizes the pickling of a task over many rois
+CHUNKS_IN_FLIGHT = 2  # per process, keeps the pool busy without reading all the rois ahead
+GRID_FIELDS = ('tile_size', 'world_bbox', 'is_mercator', 'is_lla', 'min_zoom', 'max_zoom', 'layer_name')
+
+
+@dataclasses.dataclass
+class RoiMesh:
+    """Tiles and mesh of one roi as plain arrays, cheap to send between processes.
+
+    tiles is (N, 3) int32 zoom, x, y in the order of the mesh layers, vertices, indices and draw_ranges
+    are those of CompactTileMesh, whose positions are normalized to aoi_bounds, grid corners at
+    frame_zoom. An roi touching no tile has empty arrays.
+    """
+    roi_index: int
+    tiles: np.ndarray
+    vertices: np.ndarray
+    indices: np.ndarray
+    draw_ranges: np.ndarray
+    aoi_bounds: np.ndarray
+    frame_zoom: int
+
+    def tile_indices(self, manager: WorldTextureManager) -> List[WorldTileIndex]:
+        return [WorldTileIndex(manager, zoom, x, y) for zoom, x, y in self.tiles.tolist()]
+
+    def to_mesh(self, manager: WorldTextureManager) -> CompactTileMesh:
+        return CompactTileMesh(self.tile_indices(manager), self.vertices, self.indices, self.draw_ranges)
+
+
+_worker_querier: WorldTextureQuerier = None
+_worker_builder: TileGeometryBuilder = None
+
+
+def _init_worker(grid: Dict):
+    # runs once in every pool process, the query only needs the grid of the manager and never loads a tile
+    global _worker_querier, _worker_builder
+    manager = WorldTextureManager()
+    for field, value in grid.items():
+        setattr(manager, field, value)
+    _worker_querier = WorldTextureQuerier(manager)
+    _worker_builder = TileGeometryBuilder()
+
+
+def _roi_mesh(querier: WorldTextureQuerier, builder: TileGeometryBuilder, roi_index: int, roi: Polygon,
+              meter_per_pixels) -> RoiMesh:
+    tiles = querier.get_tile_list_for_area(roi, meter_per_pixels)
+    if not tiles:
+        return RoiMesh(roi_index, np.zeros((0, 3), dtype=np.int32), np.zeros((0, 5), dtype=np.float32),
+                       np.zeros(0, dtype=np.uint32), np.zeros((0, 2), dtype=np.uint32), np.zeros((2, 2)), 0)
+    mesh = builder.tesselate_tiles_compact(tiles)
+    tile_array = np.array([(tile.zoom, tile.x, tile.y) for tile in mesh.tiles], dtype=np.int32)
+    return RoiMesh(roi_index, tile_array, mesh.vertices, mesh.indices, mesh.draw_ranges,
+                   builder.aoi_bounds, builder._max_zoom_level)
+
+
+def _process_chunk(chunk: List[Tuple[int, Polygon, object]]) -> List[RoiMesh]:
+    return [_roi_mesh(_worker_querier, _worker_builder, *item) for item in chunk]
+
+
+def batch_tesselate(manager: WorldTextureManager, rois: Iterable[Polygon],
+                    meter_per_pixels: Union[float, Iterable], processes: int = BATCH_PROCESSES,
+                    chunk_size: int = BATCH_CHUNK) -> Iterator[RoiMesh]:
+    """Queries and tesselates every roi on a process pool, yields a RoiMesh per roi in completion order.
+
+    meter_per_pixels is one value for all the rois or one entry per roi, each entry as taken by
+    get_tile_list_for_area(). roi_index tells which roi a result belongs to. Rois are read lazily,
+    only CHUNKS_IN_FLIGHT chunks per process are pending at a time.
+    """
+    if isinstance(meter_per_pixels, numbers.Number):
+        meter_per_pixels = itertools.repeat(meter_per_pixels)
+    items = zip(itertools.count(), rois, meter_per_pixels)
+    grid = {field: getattr(manager, field) for field in GRID_FIELDS}
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(grid,)) as executor:
+        in_flight = set()
+        while True:
+            while len(in_flight) < CHUNKS_IN_FLIGHT * processes:
+                chunk = list(itertools.islice(items, chunk_size))
+                if not chunk:
+                    break
+                in_flight.add(executor.submit(_process_chunk, chunk))
+            if not in_flight:
+                return
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+
+
+def _random_rois(count: int, seed: int = 0) -> List[Polygon]:
+    rng = np.random.default_rng(seed)
+    rois = []
+    for lon, lat, size in zip(rng.uniform(34, 35.5, count), rng.uniform(29.5, 33, count), rng.uniform(0.005, 0.05, count)):
+        rois.append(Polygon([(lon, lat), (lon + size, lat + size / 4), (lon + size / 2, lat + size), (lon - size / 4, lat + size / 2)]))
+    return rois
+
+
+def _benchmark_batch_tessellation(count: int = 2000, meter_per_pixel: float = 5):
+    """Rois per second of a plain loop against the pool at growing process counts"""
+    manager = WorldTextureManager()
+    rois = _random_rois(count)
+    querier, builder = WorldTextureQuerier(manager), TileGeometryBuilder()
+    start = time.perf_counter()
+    serial = [_roi_mesh(querier, builder, index, roi, meter_per_pixel) for index, roi in enumerate(rois)]
+    print(f'loop: {count / (time.perf_counter() - start):.0f} rois/s')
+    for processes in sorted({1, 2, 4, BATCH_PROCESSES}):
+        start = time.perf_counter()
+        results = list(batch_tesselate(manager, rois, meter_per_pixel, processes=processes))
+        print(f'{processes} processes: {count / (time.perf_counter() - start):.0f} rois/s')
+        assert len(results) == count
+        for result in results:
+            expected = serial[result.roi_index]
+            assert np.array_equal(result.tiles, expected.tiles) and np.array_equal(result.indices, expected.indices)
+
+
+if __name__ == '__main__':
+    _benchmark_batch_tessellation()
@@ -0,0 +1,230 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+
+from world_render.geometrizer import CompactTileMesh, TileBuffers, TileGeometryBuilder
+from world_render.world_textures.texture_manager import WorldTextureManager, WorldTileIndex
+
+NEAREST = 'nearest'
+BILINEAR = 'bilinear'
+COMPOSITE_WORKERS = os.cpu_count() or 4
+BAND_ROWS = 64  # output rows rasterized by one job
+BATCH_PIXELS = 2 ** 20  # pixels shaded at once, bounds the temporary arrays of a job
+INSIDE_EPSILON = 1e-7  # pixel centers on a shared edge go to both triangles, no cracks between them
+
+Window = Tuple[float, float, float, float]  # min x, min y, max x, max y grid positions of the output zoom
+
+
+def stack_textures(tiles: Sequence, rasters: Dict[object, np.ndarray], tile_size: int = 256) -> np.ndarray:
+    """(T, size, size, 4) uint8 textures in tiles order, tiles without a raster are transparent.
+    The rasterizer reads them as uint32 texels, one per RGBA pixel.
+    """
+    textures = np.zeros((len(tiles), tile_size, tile_size, 4), dtype=np.uint8)
+    for layer, tile in enumerate(tiles):
+        raster = rasters.get(tile)
+        if raster is not None:
+            textures[layer, :, :, :raster.shape[2]] = raster
+            if raster.shape[2] == 3:
+                textures[layer, :, :, 3] = 255
+    return textures
+
+
+def _sample(texels: np.ndarray, size: Tuple[int, int], layers: np.ndarray, u: np.ndarray, v: np.ndarray,
+            filter: str) -> np.ndarray:
+    """Texels are the textures as one flat uint32 RGBA array, returns the (P,) uint32 RGBA samples"""
+    # u is flipped in the meshes, the shaders sample at 1 - u
+    size_y, size_x = size
+    s = (1 - u) * size_x - 0.5
+    t = v * size_y - 0.5
+    base = layers * (size_y * size_x)
+    if filter == NEAREST:
+        s = np.clip(np.rint(s), 0, size_x - 1).astype(np.int64)
+        t = np.clip(np.rint(t), 0, size_y - 1).astype(np.int64)
+        return texels[base + t * size_x + s]
+    s0, t0 = np.floor(s), np.floor(t)
+    fs, ft = (s - s0).astype(np.float32)[:, None], (t - t0).astype(np.float32)[:, None]
+    s1, t1 = np.clip(s0 + 1, 0, size_x - 1).astype(np.int64), (np.clip(t0 + 1, 0, size_y - 1) * size_x).astype(np.int64)
+    s0, t0 = np.clip(s0, 0, size_x - 1).astype(np.int64), (np.clip(t0, 0, size_y - 1) * size_x).astype(np.int64)
+    corners = [texels[base + t + s].view(np.uint8).reshape(-1, 4).astype(np.float32) for t in (t0, t1) for s in (s0, s1)]
+    top = corners[0] + (corners[1] - corners[0]) * fs
+    bottom = corners[2] + (corners[3] - corners[2]) * fs
+    return np.rint(top + (bottom - top) * ft).astype(np.uint8).view(np.uint32).ravel()
+
+
+def _planes(positions: np.ndarray, values: np.ndarray, triangles: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Per triangle (a, b, c) planes, values[k] = a * x + b * y + c, and the (a, b, c) of the three
+    barycentric edge functions, rows with a zero area triangle are nan
+    """
+    (x0, y0), (x1, y1), (x2, y2) = (positions[triangles[:, k]].T for k in range(3))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        area = (y1 - y2) * (x0 - x2) + (x2 - x1) * (y0 - y2)
+        a0, b0 = (y1 - y2) / area, (x2 - x1) / area
+        a1, b1 = (y2 - y0) / area, (x0 - x2) / area
+    c0, c1 = -(a0 * x2 + b0 * y2), -(a1 * x2 + b1 * y2)
+    edges = np.stack([np.stack([a0, b0, c0], axis=-1), np.stack([a1, b1, c1], axis=-1),
+                      np.stack([-a0 - a1, -b0 - b1, 1 - c0 - c1], axis=-1)], axis=1)  # (M, 3 edges, 3)
+    v0, v1, v2 = (values[triangles[:, k]] for k in range(3))  # (M, K)
+    planes = np.stack([(v0 - v2) * a0[:, None] + (v1 - v2) * a1[:, None],
+                       (v0 - v2) * b0[:, None] + (v1 - v2) * b1[:, None],
+                       v2 + (v0 - v2) * c0[:, None] + (v1 - v2) * c1[:, None]], axis=1)  # (M, 3, K)
+    return planes, edges
+
+
+def rasterize_triangles(positions: np.ndarray, texcoords: np.ndarray, layers: np.ndarray, triangles: np.ndarray,
+                        textures: np.ndarray, out: np.ndarray, filter: str = BILINEAR, rows: Tuple[int, int] = None):
+    """Draws the textured triangles into the C contiguous (H, W, 4) uint8 out, sampling at the pixel centers.
+
+    positions are (N, 2) output pixel positions, texcoords (N, 2) the mesh u, v and layers (N,) the
+    texture of every vertex, triangles (M, 3) vertex indices. rows limits the drawing to [first, last).
+    Every triangle row is cut to the span where all three barycentric weights are positive, so only
+    covered pixels are generated, and u, v are evaluated from per triangle planes.
+    """
+    first_row, last_row = rows or (0, out.shape[0])
+    ys = positions[triangles, 1]
+    row_from = np.maximum(np.ceil(ys.min(axis=1) - 0.5), first_row).astype(np.int64)
+    row_to = np.minimum(np.floor(ys.max(axis=1) - 0.5), last_row - 1).astype(np.int64)
+    selected = np.flatnonzero(row_from <= row_to)
+    planes, edges = _planes(positions, texcoords, triangles[selected])
+    valid = np.isfinite(edges).all(axis=(1, 2))
+    selected, planes, edges = selected[valid], planes[valid], edges[valid]
+    triangle_layers = layers[triangles[selected, 0]]
+
+    # (triangle, row) spans
+    row_counts = row_to[selected] - row_from[selected] + 1
+    span_triangle = np.repeat(np.arange(len(selected)), row_counts)
+    span_row = row_from[selected][span_triangle] + np.arange(row_counts.sum()) \
+        - np.repeat(np.cumsum(row_counts) - row_counts, row_counts)
+    cy = span_row + 0.5
+    span_edges = edges[span_triangle]  # (S, 3, 3)
+    a = span_edges[:, :, 0]
+    rest = span_edges[:, :, 1] * cy[:, None] + span_edges[:, :, 2] + INSIDE_EPSILON  # a * cx + rest >= 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bound = -rest / a
+    left = np.where(a > 0, bound, -np.inf).max(axis=1)
+    right = np.where(a < 0, bound, np.inf).min(axis=1)
+    right = np.where(((a == 0) & (rest < 0)).any(axis=1), -np.inf, right)
+    col_from = np.maximum(np.ceil(left - 0.5), 0)
+    col_to = np.minimum(np.floor(right - 0.5), out.shape[1] - 1)
+    keep = col_from <= col_to
+    span_triangle, span_row = span_triangle[keep], span_row[keep]
+    col_from = col_from[keep].astype(np.int64)
+    widths = col_to[keep].astype(np.int64) - col_from + 1
+
+    # uv at the first pixel center of every span and its step per pixel
+    span_planes = planes[span_triangle]  # (S, 3, 2)
+    span_uv = span_planes[:, 0] * (col_from + 0.5)[:, None] + span_planes[:, 1] * (span_row + 0.5)[:, None] \
+        + span_planes[:, 2]
+    span_step = span_planes[:, 0]
+    span_layer = triangle_layers[span_triangle]
+    span_pixel = span_row * out.shape[1] + col_from
+
+    texels = textures.view(np.uint32).reshape(-1)
+    pixels = out.view(np.uint32).reshape(-1)
+    span_start = 0
+    while span_start < len(widths):
+        ends = np.cumsum(widths[span_start:])
+        span_end = span_start + max(1, int(np.searchsorted(ends, BATCH_PIXELS, side='right')))
+        batch = slice(span_start, span_end)
+        span_start = span_end
+
+        counts = widths[batch]
+        offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        u = np.repeat(span_uv[batch, 0], counts) + np.repeat(span_step[batch, 0], counts) * offset
+        v = np.repeat(span_uv[batch, 1], counts) + np.repeat(span_step[batch, 1], counts) * offset
+        pixels[np.repeat(span_pixel[batch], counts) + offset] = \
+            _sample(texels, textures.shape[1:3], np.repeat(span_layer[batch], counts), u, v, filter)
+
+
+class CpuCompositor:
+    """Headless alternative to the moderngl path, rasterizes the tile meshes into numpy images.
+
+    The output is split in bands of BAND_ROWS rows drawn on a thread pool, numpy releases the GIL
+    in the heavy array operations so the bands run in parallel.
+    """
+
+    def __init__(self, manager: WorldTextureManager = None, filter: str = BILINEAR, workers: int = COMPOSITE_WORKERS):
+        self._manager = manager or TileGeometryBuilder.manager
+        self.filter = filter
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='cpu-compositor')
+
+    def rasterize(self, positions: np.ndarray, texcoords: np.ndarray, layers: np.ndarray, triangles: np.ndarray,
+                  textures: np.ndarray, size: Tuple[int, int], out: np.ndarray = None) -> np.ndarray:
+        """rasterize_triangles() into a new (height, width, 4) image, size is (width, height)"""
+        if out is None:
+            out = np.zeros((size[1], size[0], 4), dtype=np.uint8)
+        jobs = [self._executor.submit(rasterize_triangles, positions, texcoords, layers, triangles, textures, out,
+                                      self.filter, (row, min(row + BAND_ROWS, out.shape[0])))
+                for row in range(0, out.shape[0], BAND_ROWS)]
+        for job in jobs:
+            job.result()
+        return out
+
+    def composite_buffers(self, buffers: Iterable[TileBuffers], rasters: Dict[WorldTileIndex, np.ndarray],
+                          size: Tuple[int, int]) -> np.ndarray:
+        """Draws TileBuffers over the whole image, as the renderer does with their normalized vertices"""
+        buffers = [buffer for buffer in buffers if buffer.vertices is not None]
+        if not buffers:
+            return np.zeros((size[1], size[0], 4), dtype=np.uint8)
+        counts = [len(buffer.vertices) for buffer in buffers]
+        offsets = np.r_[0, np.cumsum(counts)[:-1]]
+        positions = np.concatenate([buffer.vertices for buffer in buffers]) * size
+        texcoords = np.concatenate([buffer.texcoords for buffer in buffers])
+        layers = np.repeat(np.arange(len(buffers)), counts)
+        triangles = np.concatenate([buffer.indices.reshape(-1, 3).astype(np.int64) + offset
+                                    for buffer, offset in zip(buffers, offsets)])
+        textures = stack_textures([buffer.tile for buffer in buffers], rasters, self._manager.tile_size)
+        return self.rasterize(positions, texcoords, layers, triangles, textures, size)
+
+    def composite_mesh(self, mesh: CompactTileMesh, frame: Tuple[np.ndarray, int], rasters: Dict, zoom: int,
+                       window: Window, size: Tuple[int, int], out: np.ndarray = None) -> np.ndarray:
+        """Draws the part of a compact mesh in the window, frame is the (aoi bounds, grid zoom) of its vertices"""
+        aoi_bounds, frame_zoom = frame
+        grid = (mesh.vertices[:, 0:2].astype(np.float64) * (aoi_bounds[1] - aoi_bounds[0]) + aoi_bounds[0]) \
+            / 2.0 ** (frame_zoom - zoom)
+        positions = (grid - window[:2]) / (np.array(window[2:]) - window[:2]) * size
+        layers = mesh.vertices[:, 4].astype(np.int64)
+        textures = stack_textures(mesh.tiles, rasters, self._manager.tile_size)
+        return self.rasterize(positions, mesh.vertices[:, 2:4].astype(np.float64), layers,
+                              mesh.indices.reshape(-1, 3).astype(np.int64), textures, size, out)
+
+    def composite_tiles(self, tiles: Iterable[WorldTileIndex], zoom: int, window: Window, size: Tuple[int, int],
+                        rasters: Optional[Dict] = None, out: np.ndarray = None) -> np.ndarray:
+        """Renders the tiles in the window, given in grid positions of zoom, loading their rasters if not given"""
+        tiles = list(tiles)
+        if not tiles:
+            return np.zeros((size[1], size[0], 4), dtype=np.uint8) if out is None else out
+        if rasters is None:
+            rasters = dict(self._manager.load_tiles(tiles))
+        builder = TileGeometryBuilder()
+        mesh = builder.tesselate_tiles_compact(tiles)
+        return self.composite_mesh(mesh, (builder.aoi_bounds, builder._max_zoom_level), rasters, zoom, window,
+                                   size, out)
+
+
+def _benchmark_cpu_compositor(size: int = 2048, tiles_per_side: int = 8):
+    """Megapixels per second of a mixed zoom view, single band against the thread pool and both filters"""
+    import time
+    from world_render.world_textures.tile_codec import _synthetic_tile
+    manager = TileGeometryBuilder.manager
+    zoom, first = 10, 500
+    tiles = []
+    for x in range(first, first + tiles_per_side):
+        for y in range(first, first + tiles_per_side):
+            tile = WorldTileIndex(manager, zoom, x, y)
+            tiles.extend(tile.get_children() if (x + y) % 3 == 0 else [tile])
+    rasters = {tile: _synthetic_tile(index) for index, tile in enumerate(tiles)}
+    window = (first, first, first + tiles_per_side, first + tiles_per_side)
+    for filter in (NEAREST, BILINEAR):
+        for workers in (1, COMPOSITE_WORKERS):
+            compositor = CpuCompositor(manager, filter, workers)
+            start = time.perf_counter()
+            image = compositor.composite_tiles(tiles, zoom, window, (size, size), rasters)
+            elapsed = time.perf_counter() - start
+            assert image[:, :, 3].all(), 'the tiles cover the whole window'
+            print(f'{filter} on {workers} workers: {size * size / 1e6 / elapsed:.1f} megapixels/s')
+
+
+if __name__ == '__main__':
+    _benchmark_cpu_compositor()
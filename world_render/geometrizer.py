@@ -1,15 +1,155 @@
+import dataclasses
 import enum
+from bisect import bisect_left, bisect_right, insort
 from collections import defaultdict
-from typing import List, Iterable, Tuple, Dict
+from typing import Dict, List, Iterable, Optional, Set, Tuple
 from itertools import chain
 
 import numpy as np
 
+from world_render.tile_atlas import TileAtlas
+from world_render.world_textures.coord_convertor import ecef_to_enu, lla_to_ecef, lla_to_ecef_array
 from world_render.world_textures.texture_manager import WorldTextureManager, WorldTileIndex
-from world_render.world_textures.utils import Corner
+from world_render.world_textures.tile_math import grid_to_lonlat, tiles_mpp
+from world_render.world_textures.utils import Corner, morton_encode
 
 HAS_TEXTURE = 32
-TileCondition = Dict[WorldTileIndex, int]
+ALL_CORNERS = Corner.BL | Corner.BR | Corner.TL | Corner.TR
+GLOBE_SUBDIVISIONS = 8
+SKIRT_RATIO = 0.5  # skirt depth relative to a grid step, far deeper than the sagitta of a coarser neighbour's step
+
+
+class CornerIndex:
+    """Tile corner vertices indexed by the vertical and horizontal grid line they lie on"""
+
+    def __init__(self, vertices: Iterable[Tuple[int, int]]):
+        by_x, by_y = defaultdict(set), defaultdict(set)
+        for x, y in vertices:
+            by_x[x].add(y)
+            by_y[y].add(x)
+        self._by_x = {x: sorted(ys) for x, ys in by_x.items()}
+        self._by_y = {y: sorted(xs) for y, xs in by_y.items()}
+
+    @classmethod
+    def from_arrays(cls, xs: np.ndarray, ys: np.ndarray) -> 'CornerIndex':
+        index = cls(())
+        index._by_x = cls._group_lines(xs, ys)
+        index._by_y = cls._group_lines(ys, xs)
+        return index
+
+    @staticmethod
+    def _group_lines(lines: np.ndarray, values: np.ndarray):
+        pairs = np.unique(np.stack([lines, values], axis=1), axis=0)
+        starts = np.flatnonzero(np.r_[True, pairs[1:, 0] != pairs[:-1, 0]])
+        return {line: group.tolist() for line, group in zip(pairs[starts, 0].tolist(), np.split(pairs[:, 1], starts[1:]))}
+
+    def add(self, x, y):
+        insort(self._by_x.setdefault(x, []), y)
+        insort(self._by_y.setdefault(y, []), x)
+
+    def remove(self, x, y):
+        for lines, line, value in ((self._by_x, x, y), (self._by_y, y, x)):
+            values = lines[line]
+            del values[bisect_left(values, value)]
+            if not values:
+                del lines[line]
+
+    @staticmethod
+    def _between(line: List[int], start, end):
+        """Values strictly between start and end ordered from start towards end"""
+        if start <= end:
+            return line[bisect_right(line, start):bisect_left(line, end)]
+        return line[bisect_right(line, end):bisect_left(line, start)][::-1]
+
+    def on_x_line(self, x_value, from_y, to_y):
+        return self._between(self._by_x.get(x_value, []), from_y, to_y)
+
+    def on_y_line(self, y_value, from_x, to_x):
+        return self._between(self._by_y.get(y_value, []), from_x, to_x)
+
+
+class LinearQuadtree:
+    """Textured tiles and all their ancestors as a Morton sorted linear quadtree.
+
+    Nodes are keyed by the Morton code of their bottom left descendant at the deepest zoom, shifted left
+    to make room for the node zoom, so sorting the keys gives a depth first pre order walk with the
+    children in get_children() order. Flags hold HAS_TEXTURE and the Corner of every child that has
+    textured descendants.
+    """
+    ZOOM_BITS = 5
+
+    def __init__(self, zooms: np.ndarray, xs: np.ndarray, ys: np.ndarray):
+        self.depth = int(zooms.max())
+        level_zooms, level_xs, level_ys, level_flags = [zooms], [xs], [ys], [np.full(len(zooms), HAS_TEXTURE)]
+        while len(zooms):
+            has_parent = zooms > 0
+            zooms, xs, ys = zooms[has_parent], xs[has_parent], ys[has_parent]
+            level_flags.append(self._relation_to_parent(xs, ys))
+            zooms, xs, ys = zooms - 1, xs >> 1, ys >> 1
+            level_zooms.append(zooms)
+            level_xs.append(xs)
+            level_ys.append(ys)
+        zooms, xs, ys = np.concatenate(level_zooms), np.concatenate(level_xs), np.concatenate(level_ys)
+        self._keys, first, inverse = np.unique(self.keys(zooms, xs, ys), return_index=True, return_inverse=True)
+        self.flags = np.zeros(len(self._keys), dtype=np.int64)
+        np.bitwise_or.at(self.flags, inverse.ravel(), np.concatenate(level_flags))
+        self.zooms, self.xs, self.ys = zooms[first], xs[first], ys[first]
+
+    @staticmethod
+    def _relation_to_parent(xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        # Corner.BL, BR, TL, TR are the bits 0-3 ordered by (y % 2, x % 2)
+        return np.left_shift(1, (xs & 1) | ((ys & 1) << 1))
+
+    def keys(self, zooms: np.ndarray, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        shift = (self.depth - zooms).astype(np.uint64)
+        codes = morton_encode(xs.astype(np.uint64) << shift, ys.astype(np.uint64) << shift)
+        return (codes << np.uint64(self.ZOOM_BITS)) | zooms.astype(np.uint64)
+
+    def lookup(self, zooms: np.ndarray, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """Flags of the given nodes, 0 for nodes not in the tree"""
+        keys = self.keys(zooms, xs, ys)
+        positions = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+        return np.where(self._keys[positions] == keys, self.flags[positions], 0)
+
+    def leaves(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Cells to draw, each textured tile is drawn over its area minus the textured tiles inside it.
+
+        Returns the key of the owning textured tile of every cell with the cell zoom/x/y, sorted by owner
+        and then in depth first order.
+        """
+        split = (self.flags & ALL_CORNERS) != 0
+        # textured tiles without textured descendants are drawn as a whole
+        whole = ~split & ((self.flags & HAS_TEXTURE) != 0)
+        cell_zooms, cell_xs, cell_ys = self.zooms[whole], self.xs[whole], self.ys[whole]
+        owners = self._keys[whole]
+
+        # the children of split nodes that aren't in the tree are drawn by their nearest textured ancestor
+        child_zooms = np.repeat(self.zooms[split] + 1, 4)
+        child_xs = (self.xs[split, None] * 2 + [0, 1, 0, 1]).ravel()
+        child_ys = (self.ys[split, None] * 2 + [0, 0, 1, 1]).ravel()
+        free = self.lookup(child_zooms, child_xs, child_ys) == 0
+        child_zooms, child_xs, child_ys = child_zooms[free], child_xs[free], child_ys[free]
+        child_owners = np.zeros(len(child_zooms), dtype=np.uint64)
+        unowned = np.ones(len(child_zooms), dtype=bool)
+        for levels_up in range(1, self.depth + 2):
+            ancestor_zooms = child_zooms - levels_up
+            candidates = unowned & (ancestor_zooms >= 0)
+            if not candidates.any():
+                break
+            zooms = ancestor_zooms[candidates]
+            xs, ys = child_xs[candidates] >> levels_up, child_ys[candidates] >> levels_up
+            textured = (self.lookup(zooms, xs, ys) & HAS_TEXTURE) != 0
+            found = np.flatnonzero(candidates)[textured]
+            child_owners[found] = self.keys(zooms[textured], xs[textured], ys[textured])
+            unowned[found] = False
+        owned = ~unowned
+
+        owners = np.concatenate([owners, child_owners[owned]])
+        cell_zooms = np.concatenate([cell_zooms, child_zooms[owned]])
+        cell_xs = np.concatenate([cell_xs, child_xs[owned]])
+        cell_ys = np.concatenate([cell_ys, child_ys[owned]])
+        order = np.lexsort((self.keys(cell_zooms, cell_xs, cell_ys), owners))
+        return owners[order], cell_zooms[order], cell_xs[order], cell_ys[order]
 
 
 class TileBuffers:  # tile graphic buffers
@@ -29,6 +169,8 @@ class TileBuffers:  # tile graphic buffers
         vertices = (vertices - self._aoi[0]) / (self._aoi[1] - self._aoi[0])
         indices += self._total_vertices
         self._total_vertices += len(vertices)
+        if self._total_vertices > 2 ** 16:
+            raise ValueError(f'{self.tile} mesh passed 16 bit indices, use TileGeometryBuilder.tesselate_tiles_compact')
         self._vertices_lists.append(vertices)
         self._texcoords_lists.append(texcoords)
         self._indices_lists.append(indices.astype(np.uint16))
@@ -69,6 +211,46 @@ class TileBuffers:  # tile graphic buffers
             yield Polygon([verts[inds[i]], verts[inds[i + 1]], verts[inds[i + 2]], verts[inds[i]]], edgecolor='black', color=colors[index % len(colors)])
 
 
+@dataclasses.dataclass
+class CompactTileMesh:
+    """Mesh of all the tiles in one interleaved float32 buffer.
+
+    Every vertex is x, y, u, v, layer where layer is the index in tiles of the tile textured on it,
+    triangles index the whole buffer as uint32 and draw_ranges holds the (first index, index count)
+    of every tile.
+    """
+    tiles: List[WorldTileIndex]
+    vertices: np.ndarray
+    indices: np.ndarray
+    draw_ranges: np.ndarray
+    VERTEX_FORMAT = '2f4 2f4 f4'
+
+    @property
+    def nbytes(self):
+        return self.vertices.nbytes + self.indices.nbytes
+
+
+@dataclasses.dataclass
+class GlobeTileMesh:
+    """Mesh of all the tiles on the WGS-84 ellipsoid for 3D views.
+
+    Every vertex is x, y, z, u, v, layer where x, y, z are ECEF meters, or east, north, up meters
+    around origin (lon, lat) when it is set, and u, v, layer are as in CompactTileMesh. Every drawn
+    cell is an n x n grid with a skirt hanging from its border, the skirts hide the cracks between
+    cells of different zooms. draw_ranges holds the (first index, index count) of every tile.
+    """
+    tiles: List[WorldTileIndex]
+    vertices: np.ndarray
+    indices: np.ndarray
+    draw_ranges: np.ndarray
+    origin: Optional[Tuple[float, float]] = None
+    VERTEX_FORMAT = '3f4 2f4 f4'
+
+    @property
+    def nbytes(self):
+        return self.vertices.nbytes + self.indices.nbytes
+
+
 class TileGeometryBuilder:
     manager = WorldTextureManager()
     WorldTileIndex(manager, 3, 4, 3)
@@ -94,70 +276,256 @@ class TileGeometryBuilder:
         return self.aoi_bounds / self.aoi_zoom_level**2
 
     def tesselate_tiles(self, tiles: Iterable[WorldTileIndex]) -> Iterable[TileBuffers]:
+        tiles = list(tiles)
         self._max_zoom_level = max((tile.zoom for tile in tiles)) + 1
-        rendered_tiles_condition: TileCondition = defaultdict(lambda: 0)
-        for tile in tiles:
-            rendered_tiles_condition[tile] |= HAS_TEXTURE
+        zooms, xs, ys = (np.array([getattr(tile, field) for tile in tiles], dtype=np.int64) for field in ('zoom', 'x', 'y'))
+        return self._generate_tile_buffers(tiles, LinearQuadtree(zooms, xs, ys))
+
+    def tesselate_tiles_compact(self, tiles: Iterable[WorldTileIndex]) -> CompactTileMesh:
+        """Same geometry as tesselate_tiles() built with array operations only, as a single CompactTileMesh"""
+        tiles = sorted(tiles, key=lambda t: t.zoom)
+        zooms, xs, ys = (np.array([getattr(tile, field) for tile in tiles], dtype=np.int64) for field in ('zoom', 'x', 'y'))
+        self._max_zoom_level = int(zooms.max()) + 1
+        quadtree = LinearQuadtree(zooms, xs, ys)
+        corner_xs, corner_ys = self._get_tiles_corner_vertices(zooms, xs, ys)
+        self._aoi_bounds = np.array([[corner_xs.min(), corner_ys.min()], [corner_xs.max(), corner_ys.max()]])
+
+        owners, cell_zooms, cell_xs, cell_ys = quadtree.leaves()
+        tile_keys = quadtree.keys(zooms, xs, ys)
+        unique_keys, first_tile = np.unique(tile_keys, return_index=True)
+        cell_layers = first_tile[np.searchsorted(unique_keys, owners)]
+        points, counts = self._fan_vertices(cell_zooms, cell_xs, cell_ys, corner_xs, corner_ys)
+
+        vertices = np.empty((len(points), 5), dtype=np.float32)
+        vertices[:, 0:2] = (points - self.aoi_bounds[0]) / (self.aoi_bounds[1] - self.aoi_bounds[0])
+        vertex_layers = np.repeat(cell_layers, counts)
+        full_factors = np.left_shift(1, self._max_zoom_level - zooms[vertex_layers])[:, None]
+        texcoords = (points - np.stack([xs[vertex_layers], ys[vertex_layers]], axis=1) * full_factors) / full_factors
+        vertices[:, 2] = 1 - texcoords[:, 0]
+        vertices[:, 3] = texcoords[:, 1]
+        vertices[:, 4] = vertex_layers
+
+        # triangle fans around the cell centers, k runs over the boundary vertices and the last closes the fan
+        triangle_counts = counts - 1
+        cell_starts = np.r_[0, np.cumsum(counts)[:-1]]
+        triangle_offsets = np.r_[0, np.cumsum(triangle_counts)]
+        triangle_cells = np.repeat(np.arange(len(counts)), triangle_counts)
+        k = np.arange(triangle_offsets[-1]) - triangle_offsets[triangle_cells] + 1
+        indices = np.empty((len(k), 3), dtype=np.uint32)
+        indices[:, 0] = cell_starts[triangle_cells]
+        indices[:, 1] = cell_starts[triangle_cells] + k
+        indices[:, 2] = cell_starts[triangle_cells] + np.where(k == triangle_counts[triangle_cells], 1, k + 1)
+
+        starts = triangle_offsets[np.searchsorted(owners, tile_keys, side='left')]
+        ends = triangle_offsets[np.searchsorted(owners, tile_keys, side='right')]
+        draw_ranges = np.stack([starts * 3, (ends - starts) * 3], axis=1).astype(np.uint32)
+        return CompactTileMesh(tiles, vertices, indices.ravel(), draw_ranges)
+
+    def tesselate_tiles_globe(self, tiles: Iterable[WorldTileIndex], subdivisions: int = GLOBE_SUBDIVISIONS,
+                              enu: bool = False, origin: Tuple[float, float] = None) -> GlobeTileMesh:
+        """The cells of tesselate_tiles_compact() as subdivisions x subdivisions grids on the ellipsoid, all
+        the vertices converted in one batch. enu gives east, north, up vertices around origin, which
+        defaults to the center of the tiles, float32 ECEF is only good to about half a meter.
+        """
+        n = subdivisions
+        tiles = sorted(tiles, key=lambda t: t.zoom)
+        manager = tiles[0]._manager
+        zooms, xs, ys = (np.array([getattr(tile, field) for tile in tiles], dtype=np.int64) for field in ('zoom', 'x', 'y'))
+        quadtree = LinearQuadtree(zooms, xs, ys)
+        owners, cell_zooms, cell_xs, cell_ys = quadtree.leaves()
+        tile_keys = quadtree.keys(zooms, xs, ys)
+        unique_keys, first_tile = np.unique(tile_keys, return_index=True)
+        cell_layers = first_tile[np.searchsorted(unique_keys, owners)]
+
+        # (cells, n + 1, n + 1) grid positions, rows along y
+        steps = np.arange(n + 1) / n
+        grid_xs = np.broadcast_to((cell_xs[:, None] + steps)[:, None, :], (len(owners), n + 1, n + 1))
+        grid_ys = np.broadcast_to((cell_ys[:, None] + steps)[:, :, None], (len(owners), n + 1, n + 1))
+        lon, lat = grid_to_lonlat(manager, cell_zooms[:, None, None], grid_xs, grid_ys)
+        ring = self._grid_ring(n)
+        skirt_depths = tiles_mpp(manager, cell_zooms, cell_xs, cell_ys) * manager.tile_size / n * SKIRT_RATIO
+        flat_lon, flat_lat = lon.reshape(len(owners), -1), lat.reshape(len(owners), -1)
+        vertex_lon = np.concatenate([flat_lon, flat_lon[:, ring]], axis=1)
+        vertex_lat = np.concatenate([flat_lat, flat_lat[:, ring]], axis=1)
+        vertex_alt = np.concatenate([np.zeros_like(flat_lon), np.repeat(-skirt_depths[:, None], len(ring), axis=1)], axis=1)
+        positions = lla_to_ecef_array(vertex_lon, vertex_lat, vertex_alt)
+        if enu:
+            if origin is None:
+                origin = (float(lon.min() + lon.max()) / 2, float(lat.min() + lat.max()) / 2)
+            positions = ecef_to_enu(positions, *origin)
+
+        # texcoords in the owning tile, u flipped as in the other modes
+        scales = np.exp2(cell_zooms - zooms[cell_layers])[:, None, None]
+        u = 1 - (grid_xs / scales - xs[cell_layers][:, None, None]).reshape(len(owners), -1)
+        v = (grid_ys / scales - ys[cell_layers][:, None, None]).reshape(len(owners), -1)
+        vertices = np.empty(positions.shape[:2] + (6,), dtype=np.float32)
+        vertices[:, :, 0:3] = positions
+        vertices[:, :, 3] = np.concatenate([u, u[:, ring]], axis=1)
+        vertices[:, :, 4] = np.concatenate([v, v[:, ring]], axis=1)
+        vertices[:, :, 5] = cell_layers[:, None]
+
+        template = self._globe_cell_indices(n)
+        cell_vertices = vertices.shape[1]
+        indices = (template[None, :] + (np.arange(len(owners), dtype=np.int64) * cell_vertices)[:, None]).astype(np.uint32)
+        starts = np.searchsorted(owners, tile_keys, side='left')
+        ends = np.searchsorted(owners, tile_keys, side='right')
+        draw_ranges = np.stack([starts, ends - starts], axis=1).astype(np.uint32) * len(template)
+        return GlobeTileMesh(tiles, vertices.reshape(-1, 6), indices.ravel(), draw_ranges, origin if enu else None)
 
-            child_tile, tile = tile, tile.parent
-            ancestor_updated = False
-            while tile and not ancestor_updated:
-                ancestor_updated = tile in rendered_tiles_condition
-                rendered_tiles_condition[tile] |= self._get_relation_to_parent(child_tile)
-                child_tile, tile = tile, tile.parent
+    @staticmethod
+    def _grid_ring(n: int) -> np.ndarray:
+        """Border of an (n + 1) x (n + 1) grid counterclockwise, 4n vertex indices"""
+        side = np.arange(n)
+        return np.concatenate([side, n + side * (n + 1), (n + 1) * (n + 1) - 1 - side, (n - side) * (n + 1)])
 
-        return self._generate_tile_buffers(tiles, rendered_tiles_condition)
+    @staticmethod
+    def _globe_cell_indices(n: int) -> np.ndarray:
+        """Triangles of one cell, two per grid quad and two per skirt segment"""
+        rows, columns = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+        v00 = (rows * (n + 1) + columns).ravel()
+        v10, v01, v11 = v00 + 1, v00 + n + 1, v00 + n + 2
+        quads = np.stack([v00, v10, v11, v00, v11, v01], axis=1)
+        ring = TileGeometryBuilder._grid_ring(n)
+        skirt = (n + 1) * (n + 1) + np.arange(len(ring))
+        next_ring, next_skirt = np.roll(ring, -1), np.roll(skirt, -1)
+        skirts = np.stack([ring, skirt, next_skirt, ring, next_skirt, next_ring], axis=1)
+        return np.concatenate([quads.ravel(), skirts.ravel()])
+
+    def tesselate_tiles_atlas(self, tiles: Iterable[WorldTileIndex], atlas: TileAtlas) \
+            -> Tuple[CompactTileMesh, np.ndarray]:
+        """tesselate_tiles_compact() for tiles resident in the atlas, see remap_to_atlas()"""
+        return self.remap_to_atlas(self.tesselate_tiles_compact(tiles), atlas)
 
-    def _get_relation_to_parent(self, tile: WorldTileIndex):
-        return (Corner.TR if tile.y % 2 else Corner.BR) \
-            if tile.x % 2 else \
-            (Corner.TL if tile.y % 2 else Corner.BL)
+    @staticmethod
+    def remap_to_atlas(mesh: CompactTileMesh, atlas: TileAtlas) -> Tuple[CompactTileMesh, np.ndarray]:
+        """Points the vertex layers at the atlas layers and groups the triangles by atlas page.
+
+        The tiles are reordered by page, so every page is drawn by a single call over the
+        (first index, index count) the returned (pages, 2) uint32 array holds for it. A tile that
+        isn't resident yet is drawn with the sub-rect of its nearest resident ancestor, tiles with
+        no resident ancestor go last and are left out of the page ranges.
+        """
+        slots, levels, offsets = TileGeometryBuilder._atlas_sources(mesh.tiles, atlas)
+        pages = np.where(slots >= 0, slots // atlas.page_layers, atlas.pages)
+        layers = np.maximum(slots, 0) % atlas.page_layers
+        vertex_tiles = mesh.vertices[:, 4].astype(np.int64)
+        vertices = mesh.vertices.copy()
+        vertices[:, 4] = layers[vertex_tiles]
+        # u is flipped in the meshes, the tile covers [offset, offset + 1] / 2 ** level of the ancestor
+        scales = np.exp2(-levels)[vertex_tiles]
+        vertices[:, 2] = 1 - (offsets[vertex_tiles, 0] + 1 - mesh.vertices[:, 2].astype(np.float64)) * scales
+        vertices[:, 3] = (offsets[vertex_tiles, 1] + mesh.vertices[:, 3].astype(np.float64)) * scales
+
+        order = np.argsort(pages, kind='stable')
+        starts, counts = mesh.draw_ranges[order, 0].astype(np.int64), mesh.draw_ranges[order, 1].astype(np.int64)
+        new_starts = np.r_[0, np.cumsum(counts)[:-1]]
+        gather = np.repeat(starts - new_starts, counts) + np.arange(counts.sum())
+        draw_ranges = np.stack([new_starts, counts], axis=1).astype(np.uint32)
+
+        page_counts = np.bincount(pages, weights=mesh.draw_ranges[:, 1], minlength=atlas.pages + 1).astype(np.int64)
+        page_ranges = np.stack([np.r_[0, np.cumsum(page_counts)[:-1]], page_counts], axis=1)[:atlas.pages]
+        tiles = [mesh.tiles[index] for index in order]
+        return CompactTileMesh(tiles, vertices, mesh.indices[gather], draw_ranges), page_ranges.astype(np.uint32)
 
-    def _generate_tile_buffers(self, textured_tiles: Iterable[WorldTileIndex], tiles_condition: TileCondition):
+    @staticmethod
+    def _atlas_sources(tiles: List[WorldTileIndex], atlas: TileAtlas) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Atlas slot textured on every tile, -1 if none, the zoom levels between the tile and the slot
+        tile and the (x, y) offset of the tile inside it in tiles of its own zoom
+        """
+        slots = np.full(len(tiles), -1, dtype=np.int64)
+        levels = np.zeros(len(tiles), dtype=np.int64)
+        offsets = np.zeros((len(tiles), 2), dtype=np.int64)
+        for index, tile in enumerate(tiles):
+            source = tile
+            while source.zoom >= 0 and source not in atlas:
+                source = source.parent
+            if source.zoom >= 0:
+                level = tile.zoom - source.zoom
+                slots[index], levels[index] = atlas.slot(source), level
+                offsets[index] = tile.x - (source.x << level), tile.y - (source.y << level)
+        return slots, levels, offsets
+
+    def _fan_vertices(self, zooms: np.ndarray, xs: np.ndarray, ys: np.ndarray,
+                      corner_xs: np.ndarray, corner_ys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Vertices of every cell in _add_vertexes_around_tile() order, the center and then the edges
+        counterclockwise from the bottom left corner with the corners of smaller neighbours in between.
+        Returns the (N, 2) grid positions and the vertex count of every cell.
+        """
+        factors = np.left_shift(1, self._max_zoom_level - zooms)
+        x0, x1, y0, y1 = xs * factors, (xs + 1) * factors, ys * factors, (ys + 1) * factors
+        # corners keyed by their grid line, the key order is the order along every line
+        width = np.int64(corner_xs.max() + corner_ys.max() + 1)
+        x_line_keys = np.unique(corner_xs * width + corner_ys)
+        y_line_keys = np.unique(corner_ys * width + corner_xs)
+
+        # edges left, top, right, bottom as (line keys, line, start, end)
+        edges = [(x_line_keys, x0, y0, y1), (y_line_keys, y1, x0, x1),
+                 (x_line_keys, x1, y1, y0), (y_line_keys, y0, x1, x0)]
+        counts = np.ones((len(zooms), 5), dtype=np.int64)  # the center first
+        lows, highs = [], []
+        for edge, (keys, line, start, end) in enumerate(edges):
+            low = np.searchsorted(keys, line * width + np.minimum(start, end), side='right')
+            high = np.searchsorted(keys, line * width + np.maximum(start, end), side='left')
+            counts[:, edge + 1] += high - low
+            lows.append(low)
+            highs.append(high)
+
+        segment_counts = counts.ravel()
+        segments = np.repeat(np.arange(len(segment_counts)), segment_counts)
+        segment_starts = np.r_[0, np.cumsum(segment_counts)[:-1]]
+        i = np.arange(len(segments)) - segment_starts[segments]
+        cells, kinds = segments // 5, segments % 5
+
+        points = np.empty((len(segments), 2), dtype=np.float64)
+        center = kinds == 0
+        points[center, 0] = (2 * xs[cells[center]] + 1) * factors[cells[center]] / 2
+        points[center, 1] = (2 * ys[cells[center]] + 1) * factors[cells[center]] / 2
+        for edge, (keys, line, start, end) in enumerate(edges):
+            mask = kinds == edge + 1
+            edge_cells, edge_i = cells[mask], i[mask]
+            ascending = edge < 2
+            crack = np.clip(lows[edge][edge_cells] + edge_i - 1 if ascending else highs[edge][edge_cells] - edge_i,
+                            0, len(keys) - 1)
+            values = np.where(edge_i == 0, start[edge_cells], keys[crack] - line[edge_cells] * width)
+            along, across = (1, 0) if edge % 2 == 0 else (0, 1)
+            points[mask, across] = line[edge_cells]
+            points[mask, along] = values
+        return points, counts.sum(axis=1)
+
+    def _generate_tile_buffers(self, textured_tiles: List[WorldTileIndex], quadtree: 'LinearQuadtree'):
         textured_tiles = sorted(textured_tiles, key=lambda t: t.zoom)
-        corner_vertices = self._get_tiles_corner_vertices(textured_tiles)
-        np_verts = np.array(list(corner_vertices))
-        self._aoi_bounds = np.vstack([np_verts.min(axis=0), np_verts.max(axis=0)])
-
+        zooms, xs, ys = (np.array([getattr(tile, field) for tile in textured_tiles], dtype=np.int64)
+                         for field in ('zoom', 'x', 'y'))
+        corner_xs, corner_ys = self._get_tiles_corner_vertices(zooms, xs, ys)
+        self._aoi_bounds = np.array([[corner_xs.min(), corner_ys.min()], [corner_xs.max(), corner_ys.max()]])
+        corner_index = CornerIndex.from_arrays(corner_xs, corner_ys)
+
+        owners, leaf_zooms, leaf_xs, leaf_ys = quadtree.leaves()
+        starts = np.searchsorted(owners, quadtree.keys(zooms, xs, ys), side='left')
+        ends = np.searchsorted(owners, quadtree.keys(zooms, xs, ys), side='right')
         buffers = []
-        for tile in textured_tiles:
+        for tile, start, end in zip(textured_tiles, starts.tolist(), ends.tolist()):
             buffers.append(TileBuffers(tile, self.aoi_bounds))
-            self._append_buffer_for_tile(buffers[-1], tile, tiles_condition, corner_vertices, 0)
+            for zoom, x, y in zip(leaf_zooms[start:end].tolist(), leaf_xs[start:end].tolist(), leaf_ys[start:end].tolist()):
+                self._add_vertexes_around_tile(buffers[-1], zoom, x, y, corner_index)
         return buffers
 
-    def _get_tiles_corner_vertices(self, tiles: Iterable[WorldTileIndex]):
-        vertices = set()
-        for tile in tiles:
-            factor = 2 ** (self._max_zoom_level - tile.zoom)
-            vertices.add(((tile.x + 0) * factor, (tile.y + 0) * factor))
-            vertices.add(((tile.x + 1) * factor, (tile.y + 0) * factor))
-            vertices.add(((tile.x + 0) * factor, (tile.y + 1) * factor))
-            vertices.add(((tile.x + 1) * factor, (tile.y + 1) * factor))
-        return vertices
-
-    def _append_buffer_for_tile(self, buffer: TileBuffers, tile: WorldTileIndex,
-                                tiles_condition: TileCondition, corner_vertices: List[Tuple[int, int]],
-                                iteration: int):
-        # Check if current tile as assgined to another textured tile
-        if tile in tiles_condition and tiles_condition[tile] & HAS_TEXTURE and iteration != 0:
-            return
-
-        if tile in tiles_condition and tiles_condition[tile] & (Corner.TR | Corner.BR | Corner.TL | Corner.BL):
-            for child_tile in tile.get_children():
-                self._append_buffer_for_tile(buffer, child_tile, tiles_condition, corner_vertices, iteration + 1)
-        else:
-            self._add_vertexes_around_tile(buffer, tile, corner_vertices)
+    def _get_tiles_corner_vertices(self, zooms: np.ndarray, xs: np.ndarray, ys: np.ndarray):
+        factors = np.left_shift(1, self._max_zoom_level - zooms)
+        corner_xs = np.concatenate([xs * factors, (xs + 1) * factors, xs * factors, (xs + 1) * factors])
+        corner_ys = np.concatenate([ys * factors, ys * factors, (ys + 1) * factors, (ys + 1) * factors])
+        return corner_xs, corner_ys
 
-    def _add_vertexes_around_tile(self, buffer: TileBuffers, tile: WorldTileIndex,
-                                  corners: List[Tuple[int, int]]):
+    def _add_vertexes_around_tile(self, buffer: TileBuffers, zoom: int, x: int, y: int,
+                                  corners: CornerIndex):
 
-        factor = 2 ** (self._max_zoom_level - tile.zoom)
+        factor = 2 ** (self._max_zoom_level - zoom)
         vertices = chain(
-            [((2 * tile.x + 1) * factor / 2, (2 * tile.y + 1) * factor / 2)], # center position
-            self._filter_vertices_x_aligned(corners, (tile.x + 0) * factor, (tile.y) * factor, (tile.y + 1) * factor),
-            self._filter_vertices_y_aligned(corners, (tile.y + 1) * factor, (tile.x) * factor, (tile.x + 1) * factor),
-            self._filter_vertices_x_aligned(corners, (tile.x + 1) * factor, (tile.y + 1) * factor, (tile.y) * factor),
-            self._filter_vertices_y_aligned(corners, (tile.y + 0) * factor, (tile.x + 1) * factor, (tile.x) * factor))
+            [((2 * x + 1) * factor / 2, (2 * y + 1) * factor / 2)], # center position
+            self._filter_vertices_x_aligned(corners, (x + 0) * factor, (y) * factor, (y + 1) * factor),
+            self._filter_vertices_y_aligned(corners, (y + 1) * factor, (x) * factor, (x + 1) * factor),
+            self._filter_vertices_x_aligned(corners, (x + 1) * factor, (y + 1) * factor, (y) * factor),
+            self._filter_vertices_y_aligned(corners, (y + 0) * factor, (x + 1) * factor, (x) * factor))
         vertices = np.array(list(vertices), dtype=np.float32)
 
         full_factor = 2 ** (self._max_zoom_level - buffer.tile.zoom)
@@ -174,16 +542,213 @@ class TileGeometryBuilder:
         buffer.append_vertex_buffers(vertices, texcoords, indices)
 
     @staticmethod
-    def _filter_vertices_x_aligned(vertices, x_value, from_y, to_y):
-        min_y, max_y = min(from_y, to_y), max(from_y, to_y)
-        arr = [(x_value, from_y)] + [vert for vert in vertices if vert[0] == x_value and min_y < vert[1] < max_y]
-        return sorted(arr, key=lambda v: abs(v[1] - from_y))
+    def _filter_vertices_x_aligned(vertices: CornerIndex, x_value, from_y, to_y):
+        return [(x_value, from_y)] + [(x_value, y) for y in vertices.on_x_line(x_value, from_y, to_y)]
 
     @staticmethod
-    def _filter_vertices_y_aligned(vertices, y_value, from_x, to_x):
-        min_x, max_x = min(from_x, to_x), max(from_x, to_x)
-        arr = [(from_x, y_value)] + [vert for vert in vertices if vert[1] == y_value and min_x < vert[0] < max_x]
-        return sorted(arr, key=lambda v: abs(v[0] - from_x))
+    def _filter_vertices_y_aligned(vertices: CornerIndex, y_value, from_x, to_x):
+        return [(from_x, y_value)] + [(x, y_value) for x in vertices.on_y_line(y_value, from_x, to_x)]
+
+
+class IncrementalTileGeometryBuilder(TileGeometryBuilder):
+    """Keeps the tessellation of a tile set and rebuilds only the tiles a change touches.
+
+    A tile is rebuilt when a tile is added or removed inside it (its own cells change) or when a tile
+    corner on its closed area appears or disappears (a crack fixing vertex on one of its edges changes).
+    Vertices are normalized to a fixed frame instead of the bounds of the current tiles, so panning
+    doesn't move the vertices of the tiles that stay.
+    """
+
+    def __init__(self, max_zoom: int = None, aoi_bounds: np.ndarray = None):
+        super().__init__()
+        max_zoom = self.manager.max_zoom if max_zoom is None else max_zoom
+        self._max_zoom_level = max_zoom + 1
+        world_size = 2 ** self._max_zoom_level
+        self._aoi_bounds = np.array([[0, 0], [world_size, world_size]]) if aoi_bounds is None else np.asarray(aoi_bounds)
+        self._tiles: Dict[Tuple[int, int, int], WorldTileIndex] = {}
+        self._descendants: Dict[Tuple[int, int, int], int] = defaultdict(int)  # textured tiles below every node
+        self._corner_counts: Dict[Tuple[int, int], int] = defaultdict(int)
+        self._corners = CornerIndex(())
+        self.buffers: Dict[WorldTileIndex, TileBuffers] = {}
+
+    def update(self, added: Iterable[WorldTileIndex] = (), removed: Iterable[WorldTileIndex] = ()) \
+            -> Tuple[List[TileBuffers], List[WorldTileIndex]]:
+        """Applies a tile set diff, returns the rebuilt buffers of the added and changed tiles and the removed tiles"""
+        dirty: Set[Tuple[int, int, int]] = set()
+        changed_corners = []
+        removed = [tile for tile in removed if (tile.zoom, tile.x, tile.y) in self._tiles]
+        for tile in removed:
+            node = (tile.zoom, tile.x, tile.y)
+            del self._tiles[node]
+            self.buffers.pop(tile, None)
+            self._count_ancestors(node, -1)
+            changed_corners += self._count_corners(node, -1)
+            dirty.add(self._textured_ancestor(node))
+        for tile in added:
+            node = (tile.zoom, tile.x, tile.y)
+            if node in self._tiles:
+                continue
+            if tile.zoom >= self._max_zoom_level:
+                raise ValueError(f'{tile} is deeper than the builder max zoom')
+            self._tiles[node] = tile
+            self._count_ancestors(node, 1)
+            changed_corners += self._count_corners(node, 1)
+            dirty.add(node)
+            dirty.add(self._textured_ancestor(node))
+        for corner in changed_corners:
+            dirty.update(self._tiles_around(corner))
+        dirty.discard(None)
+
+        rebuilt = []
+        for node in sorted(dirty):
+            if node not in self._tiles:
+                continue
+            buffer = TileBuffers(self._tiles[node], self.aoi_bounds)
+            for cell in self._tile_cells(node, True):
+                self._add_vertexes_around_tile(buffer, *cell, self._corners)
+            self.buffers[buffer.tile] = buffer
+            rebuilt.append(buffer)
+        return rebuilt, removed
+
+    def _count_ancestors(self, node, delta: int):
+        zoom, x, y = node
+        while zoom > 0:
+            zoom, x, y = zoom - 1, x >> 1, y >> 1
+            self._descendants[(zoom, x, y)] += delta
+            if not self._descendants[(zoom, x, y)]:
+                del self._descendants[(zoom, x, y)]
+
+    def _count_corners(self, node, delta: int) -> List[Tuple[int, int]]:
+        """Updates the corner counts of the tile, returns the corners that appeared or disappeared"""
+        zoom, x, y = node
+        factor = 2 ** (self._max_zoom_level - zoom)
+        changed = []
+        for corner in (((x + 0) * factor, (y + 0) * factor), ((x + 1) * factor, (y + 0) * factor),
+                       ((x + 0) * factor, (y + 1) * factor), ((x + 1) * factor, (y + 1) * factor)):
+            self._corner_counts[corner] += delta
+            if self._corner_counts[corner] == 0:
+                del self._corner_counts[corner]
+                self._corners.remove(*corner)
+                changed.append(corner)
+            elif self._corner_counts[corner] == 1 and delta > 0:
+                self._corners.add(*corner)
+                changed.append(corner)
+        return changed
+
+    def _textured_ancestor(self, node):
+        zoom, x, y = node
+        while zoom > 0:
+            zoom, x, y = zoom - 1, x >> 1, y >> 1
+            if (zoom, x, y) in self._tiles:
+                return zoom, x, y
+        return None
+
+    def _tiles_around(self, corner: Tuple[int, int]):
+        """Textured tiles whose closed area holds the grid point"""
+        for zoom in range(self._max_zoom_level):
+            factor = 2 ** (self._max_zoom_level - zoom)
+            for x in {corner[0] // factor, (corner[0] - 1) // factor}:
+                for y in {corner[1] // factor, (corner[1] - 1) // factor}:
+                    if (zoom, x, y) in self._tiles:
+                        yield zoom, x, y
+
+    def _tile_cells(self, node, is_root: bool):
+        """Same walk as the linear quadtree leaves, children in get_children() order"""
+        if not is_root and node in self._tiles:
+            return
+        if node in self._descendants:
+            zoom, x, y = node
+            for dy in (0, 1):
+                for dx in (0, 1):
+                    yield from self._tile_cells((zoom + 1, x * 2 + dx, y * 2 + dy), False)
+        else:
+            yield node
+
+
+def _benchmark_incremental(columns: int = 40, rows: int = 30, zoom: int = 12):
+    """Panning a view of columns x rows mixed zoom tiles by one column, incremental update against a full rebuild"""
+    import time
+    manager = WorldTextureManager()
+
+    def view(first_column):
+        tiles = []
+        for x in range(first_column, first_column + columns):
+            for y in range(1000, 1000 + rows):
+                tile = WorldTileIndex(manager, zoom, x, y)
+                tiles.extend(tile.get_children() if (x * 7 + y * 3) % 5 == 0 else [tile])
+        return tiles
+
+    builder = IncrementalTileGeometryBuilder()
+    builder.update(added=view(1000))
+    start = time.perf_counter()
+    rebuilt, removed = builder.update(added=set(view(1001)) - set(view(1000)), removed=set(view(1000)) - set(view(1001)))
+    incremental = time.perf_counter() - start
+    start = time.perf_counter()
+    TileGeometryBuilder().tesselate_tiles(view(1001))
+    full = time.perf_counter() - start
+    print(f'{len(view(1001))} tiles panned by a column: {len(rebuilt)} rebuilt and {len(removed)} removed '
+          f'in {incremental * 1000:.1f}ms, full rebuild {full * 1000:.1f}ms')
+
+
+def _benchmark_globe_mesh(count: int = 2000, subdivisions: int = GLOBE_SUBDIVISIONS, per_point_sample: int = 20000):
+    """Vertices per second of the globe mode against converting the same vertices one pyproj call at a time"""
+    import time
+    manager = TileGeometryBuilder.manager
+    tiles = _random_tile_cover(manager, count, 0, root_zoom=8)
+    start = time.perf_counter()
+    mesh = TileGeometryBuilder().tesselate_tiles_globe(tiles, subdivisions)
+    elapsed = time.perf_counter() - start
+    rng = np.random.default_rng(0)
+    lons, lats = rng.uniform(34, 35, per_point_sample).tolist(), rng.uniform(31, 32, per_point_sample).tolist()
+    start = time.perf_counter()
+    for lon, lat in zip(lons, lats):
+        lla_to_ecef(lon, lat, 0)
+    per_point = per_point_sample / (time.perf_counter() - start)
+    start = time.perf_counter()
+    lla_to_ecef_array(lons, lats, 0)
+    batched = per_point_sample / (time.perf_counter() - start)
+    print(f'{len(tiles)} tiles, {len(mesh.vertices)} vertices in {elapsed:.2f}s, {len(mesh.vertices) / elapsed:.0f} vertices/s '
+          f'for the whole mesh, conversion alone {batched:.0f} vertices/s batched against {per_point:.0f} per point')
+
+
+def _random_tile_cover(manager: WorldTextureManager, count: int, seed: int = 0, root_zoom: int = 4):
+    """Mixed zoom tiles covering a root tile without overlaps, made by randomly splitting leaves"""
+    rng = np.random.default_rng(seed)
+    leaves = [WorldTileIndex(manager, root_zoom, 3, 5)]
+    while len(leaves) + 3 <= count:
+        index = int(rng.integers(len(leaves)))
+        leaves[index], leaves[-1] = leaves[-1], leaves[index]
+        leaves.extend(leaves.pop().get_children())
+    return leaves
+
+
+def _benchmark_tesselation(counts=(10, 100, 1000, 10000, 100000)):
+    import time
+    manager = WorldTextureManager()
+    for count in counts:
+        tiles = _random_tile_cover(manager, count)
+        start = time.perf_counter()
+        buffers = TileGeometryBuilder().tesselate_tiles(tiles)
+        elapsed = time.perf_counter() - start
+        triangles = sum(len(buffer.indices) // 3 for buffer in buffers)
+        print(f'{len(tiles)} tiles: {triangles} triangles in {elapsed * 1000:.0f}ms')
+
+
+def _benchmark_compact_mesh(counts=(100, 1000, 10000, 100000)):
+    """Bytes uploaded and build time of the per tile float64 buffers against the compact mesh"""
+    import time
+    manager = WorldTextureManager()
+    for count in counts:
+        tiles = _random_tile_cover(manager, count)
+        start = time.perf_counter()
+        buffers = TileGeometryBuilder().tesselate_tiles(tiles)
+        buffers_time = time.perf_counter() - start
+        buffers_bytes = sum(buffer.vertices.nbytes + buffer.texcoords.nbytes + buffer.indices.nbytes for buffer in buffers)
+        start = time.perf_counter()
+        mesh = TileGeometryBuilder().tesselate_tiles_compact(tiles)
+        mesh_time = time.perf_counter() - start
+        print(f'{len(tiles)} tiles: buffers {buffers_bytes / 2 ** 20:.2f}MB in {buffers_time * 1000:.0f}ms, '
+              f'compact {mesh.nbytes / 2 ** 20:.2f}MB in {mesh_time * 1000:.0f}ms')
 
 
 def _example_tiles():
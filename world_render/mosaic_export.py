@@ -0,0 +1,141 @@
+import dataclasses
+import json
+import math
+import time
+from typing import Callable, Iterator, List, Tuple
+
+import numpy as np
+from shapely.geometry import Polygon, box
+from shapely.geometry.base import BaseGeometry
+
+from world_render.cpu_compositor import BILINEAR, CpuCompositor
+from world_render.world_textures.texture_manager import WorldTextureManager
+from world_render.world_textures.seeder import load_geojson, zoom_for_mpp
+
+EXPORT_WINDOW = 4096  # output pixels per window side
+REPORT_INTERVAL = 5  # seconds
+
+
+@dataclasses.dataclass
+class ExportStats:
+    windows: int = 0
+    total_windows: int = 0
+    tiles: int = 0
+    pixels: int = 0
+    elapsed: float = 0
+
+    @property
+    def megapixels_per_second(self):
+        return self.pixels / 1e6 / self.elapsed if self.elapsed else 0
+
+    def __str__(self):
+        return (f'{self.windows}/{self.total_windows} windows, {self.tiles} tiles, {self.pixels / 1e6:.1f} megapixels, '
+                f'{self.megapixels_per_second:.1f} megapixels/s')
+
+
+class MosaicExporter:
+    """Writes the orthophoto of an area to a .npy file that can be far larger than memory.
+
+    The output, the grid aligned pixel bounds of the area at the output zoom, is walked in windows.
+    Every window queries and loads only the tiles touching it, composites them on the CPU and is
+    copied into the memory mapped output, which is flushed before moving on. Peak memory is a window,
+    its tiles and the raster cache budget. Rows follow the grid y, north up on mercator grids.
+    A .json next to the output holds its zoom and pixel origin.
+    """
+
+    def __init__(self, manager: WorldTextureManager, area: BaseGeometry, meter_per_pixel: float, zoom: int = None,
+                 window: int = EXPORT_WINDOW, filter: str = BILINEAR,
+                 report: Callable[[ExportStats], None] = None):
+        self._manager = manager
+        self._area = area
+        self._mpp = meter_per_pixel
+        center = area.centroid
+        self.zoom = zoom_for_mpp(manager, meter_per_pixel, center.x, center.y) if zoom is None else zoom
+        self._window = window
+        self._compositor = CpuCompositor(manager, filter)
+        self._report = report or (lambda stats: print(stats))
+        self.stats = ExportStats()
+
+        min_lon, min_lat, max_lon, max_lat = area.bounds
+        corners = np.array([manager.wgs84lla_to_grid(self.zoom, lon, lat)
+                            for lon, lat in ((min_lon, min_lat), (max_lon, max_lat))]) * manager.tile_size
+        self.origin = (int(math.floor(corners[:, 0].min())), int(math.floor(corners[:, 1].min())))
+        self.size = (int(math.ceil(corners[:, 0].max())) - self.origin[0],
+                     int(math.ceil(corners[:, 1].max())) - self.origin[1])
+
+    def windows(self) -> Iterator[Tuple[int, int, int, int]]:
+        """(column, row, width, height) of the output windows, row major"""
+        for row in range(0, self.size[1], self._window):
+            for column in range(0, self.size[0], self._window):
+                yield column, row, min(self._window, self.size[0] - column), min(self._window, self.size[1] - row)
+
+    def _window_area(self, column: int, row: int, width: int, height: int) -> Tuple[Tuple, BaseGeometry]:
+        """Grid bounds of the window at the output zoom and its part of the area in WGS-84"""
+        tile_size = self._manager.tile_size
+        grid = ((self.origin[0] + column) / tile_size, (self.origin[1] + row) / tile_size,
+                (self.origin[0] + column + width) / tile_size, (self.origin[1] + row + height) / tile_size)
+        corners = [self._manager.grid_to_wgs84lla(self.zoom, x, y) for x, y in ((grid[0], grid[1]), (grid[2], grid[3]))]
+        lons, lats = zip(*corners)
+        return grid, self._area.intersection(box(min(lons), min(lats), max(lons), max(lats)))
+
+    def export(self, path: str) -> ExportStats:
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(self.size[1], self.size[0], 4))
+        with open(path + '.json', 'w') as f:
+            json.dump({'layer': self._manager.layer_name, 'zoom': self.zoom, 'origin': self.origin,
+                       'size': self.size, 'tile_size': self._manager.tile_size}, f)
+
+        query = self._manager.query
+        buffer = np.zeros((min(self._window, self.size[1]), min(self._window, self.size[0]), 4), dtype=np.uint8)
+        windows = list(self.windows())
+        self.stats = ExportStats(total_windows=len(windows))
+        start = last_report = time.perf_counter()
+        for column, row, width, height in windows:
+            grid, window_area = self._window_area(column, row, width, height)
+            polygons = _polygons(window_area)
+            if polygons:
+                # the query takes a single polygon, with one meter per pixel the parts share the tiles they touch
+                tiles = list(dict.fromkeys(tile for polygon in polygons
+                                           for tile in query.get_tile_list_for_area(polygon, self._mpp)))
+                # the compositor needs a contiguous image, only full width windows can reuse the buffer
+                image = buffer[:height] if width == buffer.shape[1] else np.empty((height, width, 4), np.uint8)
+                image[:] = 0
+                self._compositor.composite_tiles(tiles, self.zoom, grid, (width, height), out=image)
+                out[row:row + height, column:column + width] = image
+                out.flush()
+                self.stats.tiles += len(tiles)
+            self.stats.windows += 1
+            self.stats.pixels += width * height
+            now = time.perf_counter()
+            self.stats.elapsed = now - start
+            if now - last_report > REPORT_INTERVAL:
+                self._report(self.stats)
+                last_report = now
+        del out
+        self.stats.elapsed = time.perf_counter() - start
+        self._report(self.stats)
+        return self.stats
+
+
+def _polygons(geometry: BaseGeometry) -> List[Polygon]:
+    """The polygons with an area in the geometry, clipping a concave area can leave several or lines and points"""
+    if isinstance(geometry, Polygon):
+        return [geometry] if geometry.area > 0 else []
+    return [polygon for part in getattr(geometry, 'geoms', ()) for polygon in _polygons(part)]
+
+
+def export_mosaic(manager: WorldTextureManager, area: BaseGeometry, meter_per_pixel: float, path: str,
+                  **kwargs) -> ExportStats:
+    return MosaicExporter(manager, area, meter_per_pixel, **kwargs).export(path)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Exports the orthophoto of the area of a GeoJSON file to a .npy file')
+    parser.add_argument('geojson')
+    parser.add_argument('output')
+    parser.add_argument('--mpp', type=float, required=True, help='meter per pixel of the tiles to composite')
+    parser.add_argument('--zoom', type=int, help='output grid zoom, by default the one of --mpp at the area center')
+    parser.add_argument('--window', type=int, default=EXPORT_WINDOW)
+    args = parser.parse_args()
+    export_mosaic(WorldTextureManager(), load_geojson(args.geojson), args.mpp, args.output, zoom=args.zoom,
+                  window=args.window)
@@ -0,0 +1,137 @@
+from typing import Callable, Iterable, List, Tuple
+
+import numpy as np
+
+from world_render.tile_atlas import ATLAS_PAGE_LAYERS, TileAtlas
+
+TEXTURE_BUDGET = 2 ** 29  # bytes of tile textures kept on the GPU
+TILE_CHANNELS = 4
+
+
+class TextureResidency:
+    """Keeps the textures of the visible tiles on the GPU within a memory budget.
+
+    The budget caps the number of atlas pages, pages are created on first use and their slots are
+    reused for new tiles in LRU order, so a long session never creates more texture objects than the
+    budget allows. Rasters are dropped as soon as they are uploaded, no host copy stays around.
+    Only ctx.texture_array() and texture.write() are used, so a fake context is enough to check it.
+    """
+
+    def __init__(self, ctx, budget: int = TEXTURE_BUDGET, tile_size: int = 256,
+                 page_layers: int = ATLAS_PAGE_LAYERS):
+        self._ctx = ctx
+        self.budget = budget
+        pages = budget // self._page_bytes(tile_size, page_layers)
+        if pages < 1:
+            raise ValueError(f'a texture budget of {budget} bytes does not fit a single atlas page')
+        self.atlas = TileAtlas(pages, page_layers, tile_size)
+        self._pages = [None] * pages
+        self.uploads = 0
+        self.uploaded_bytes = 0
+
+    @staticmethod
+    def _page_bytes(tile_size: int, page_layers: int) -> int:
+        return tile_size * tile_size * TILE_CHANNELS * page_layers
+
+    @property
+    def page_bytes(self) -> int:
+        return self._page_bytes(self.atlas.tile_size, self.atlas.page_layers)
+
+    @property
+    def allocated_bytes(self) -> int:
+        return sum(page is not None for page in self._pages) * self.page_bytes
+
+    def page(self, index: int):
+        if self._pages[index] is None:
+            size = self.atlas.tile_size
+            self._pages[index] = self._ctx.texture_array((size, size, self.atlas.page_layers), TILE_CHANNELS, dtype='f1')
+        return self._pages[index]
+
+    def make_resident(self, tiles: Iterable, load: Callable[[Iterable], Iterable[Tuple[object, np.ndarray]]]) -> List:
+        """Uploads the tiles that aren't resident yet, load yields (tile, raster) for the tiles it is given.
+        Returns the uploaded tiles. The slots of the tiles load skips or yields None for are released again,
+        they still hold the texels of the tile they had before, so a later call retries those tiles.
+        """
+        placements = dict(self.atlas.allocate(tiles))
+        uploaded = []
+        for tile, image in load(list(placements)):
+            if image is None:
+                continue
+            self._write(placements[tile], image)
+            uploaded.append(tile)
+        self.atlas.release(set(placements).difference(uploaded))
+        return uploaded
+
+    def upload(self, tile, image: np.ndarray):
+        """Makes a single tile resident with the raster, for rasters arriving in the background"""
+        if image is None:
+            return
+        for _, slot in self.atlas.allocate([tile]):
+            self._write(slot, image)
+
+    def _write(self, slot: int, image: np.ndarray):
+        size = self.atlas.tile_size
+        assert image.dtype == np.uint8 and image.shape[:2] == (size, size) and image.shape[2] in (3, 4), \
+            f'tile raster of {image.dtype} {image.shape} does not fit a {size}x{size} rgba layer'
+        page, layer = self.atlas.page_layer(slot)
+        if image.shape[2] == 3:
+            image = np.concatenate([image, np.full(image.shape[:2] + (1,), 255, dtype=np.uint8)], axis=2)
+        self.page(page).write(np.ascontiguousarray(image), viewport=(0, 0, layer, image.shape[1], image.shape[0], 1))
+        self.uploads += 1
+        self.uploaded_bytes += image.nbytes
+
+    def release(self, tiles: Iterable):
+        """Frees the slots of the tiles, their textures get overwritten by the next uploads"""
+        self.atlas.release(tiles)
+
+    def use(self, page: int):
+        self.page(page).use()
+
+    def stats(self):
+        return {'resident': len(self.atlas), 'pages': sum(page is not None for page in self._pages),
+                'allocated_bytes': self.allocated_bytes, 'budget': self.budget, 'uploads': self.uploads,
+                'uploaded_bytes': self.uploaded_bytes, 'evictions': self.atlas.evictions}
+
+
+class _FakeTextureArray:
+    def __init__(self, size, components):
+        self.size = size
+        self.components = components
+        self.writes = 0
+
+    def write(self, data, viewport=None):
+        self.writes += 1
+
+    def use(self, location=0):
+        pass
+
+
+class _FakeContext:
+    """Just the texture calls TextureResidency makes, counting the textures created"""
+
+    def __init__(self):
+        self.textures = []
+
+    def texture_array(self, size, components, dtype='f1'):
+        self.textures.append(_FakeTextureArray(size, components))
+        return self.textures[-1]
+
+
+def _example_residency(frames: int = 2000, view: int = 120, tile_size: int = 64):
+    """A long pan over a fake context, texture objects and memory stay within the budget"""
+    ctx = _FakeContext()
+    page_layers = 64
+    residency = TextureResidency(ctx, budget=3 * tile_size * tile_size * TILE_CHANNELS * page_layers,
+                                 tile_size=tile_size, page_layers=page_layers)
+    raster = np.zeros((tile_size, tile_size, 3), dtype=np.uint8)
+    for frame in range(frames):
+        visible = [(frame // 4 + column, row) for column in range(view // 10) for row in range(10)]
+        residency.make_resident(visible, lambda tiles: ((tile, raster) for tile in tiles))
+        assert all(tile in residency.atlas for tile in visible)
+        assert residency.allocated_bytes <= residency.budget
+    assert len(ctx.textures) <= residency.atlas.pages
+    print(residency.stats(), f'{len(ctx.textures)} texture objects created')
+
+
+if __name__ == '__main__':
+    _example_residency()
@@ -0,0 +1,80 @@
+from collections import OrderedDict
+from typing import Hashable, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+ATLAS_PAGE_LAYERS = 256  # GL 3.3 guarantees at least 256 texture array layers
+
+
+class TileAtlas:
+    """Slot allocator of the tile textures, a slot is one layer of a texture array page.
+
+    All tiles have the same size, so a layer holds a whole tile and texcoords stay tile local, there is
+    nothing to pack and no bleeding between neighbouring tiles. Slots are reused in LRU order, the
+    tiles asked for in the same allocate() call are never evicted by it. Doesn't touch the GPU, the
+    caller uploads the placements allocate() returns.
+    """
+
+    def __init__(self, pages: int = 1, page_layers: int = ATLAS_PAGE_LAYERS, tile_size: int = 256):
+        self.pages = pages
+        self.page_layers = page_layers
+        self.tile_size = tile_size
+        self._slots: 'OrderedDict[Hashable, int]' = OrderedDict()  # least recently used first
+        self._free = list(range(self.capacity - 1, -1, -1))
+        self.evictions = 0
+
+    @property
+    def capacity(self) -> int:
+        return self.pages * self.page_layers
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, tile):
+        return tile in self._slots
+
+    def slot(self, tile) -> Optional[int]:
+        return self._slots.get(tile)
+
+    def page_layer(self, slot: int) -> Tuple[int, int]:
+        return divmod(slot, self.page_layers)
+
+    def allocate(self, tiles: Iterable[Hashable]) -> List[Tuple[Hashable, int]]:
+        """Makes all the tiles resident, returns the (tile, slot) placements that need an upload"""
+        tiles = list(dict.fromkeys(tiles))
+        if len(tiles) > self.capacity:
+            raise ValueError(f'{len(tiles)} tiles do not fit an atlas of {self.capacity} slots')
+        pinned = set(tiles)
+        placements = []
+        for tile in tiles:
+            if tile in self._slots:
+                self._slots.move_to_end(tile)
+                continue
+            if self._free:
+                slot = self._free.pop()
+            else:
+                victim = next(resident for resident in self._slots if resident not in pinned)
+                slot = self._slots.pop(victim)
+                self.evictions += 1
+            self._slots[tile] = slot
+            placements.append((tile, slot))
+        return placements
+
+    def touch(self, tiles: Iterable[Hashable]):
+        """Marks the resident tiles as used, the others are ignored"""
+        for tile in tiles:
+            if tile in self._slots:
+                self._slots.move_to_end(tile)
+
+    def release(self, tiles: Iterable[Hashable]):
+        for tile in tiles:
+            slot = self._slots.pop(tile, None)
+            if slot is not None:
+                self._free.append(slot)
+
+    def slots_of(self, tiles: Iterable[Hashable]) -> np.ndarray:
+        """Slot of every tile, all of them must be resident"""
+        try:
+            return np.array([self._slots[tile] for tile in tiles], dtype=np.int64)
+        except KeyError as e:
+            raise KeyError(f'tile {e.args[0]} is not resident in the atlas') from None
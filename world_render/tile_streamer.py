@@ -0,0 +1,67 @@
+import queue
+from functools import partial
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from world_render.world_textures.texture_manager import WorldTextureManager, WorldTileIndex
+
+UPLOADS_PER_FRAME = 16  # rasters handed to the render thread per drain(), bounds the upload time of a frame
+PLACEHOLDER_LEVELS = 3  # ancestors this many levels up are loaded ahead of the tiles as placeholders
+
+
+class TileStreamer:
+    """Loads tiles in the background and hands their rasters to the render thread through a queue.
+
+    request() never blocks, the loads run on the fetcher pool and deliver to the queue when done.
+    The render thread picks up a bounded number of rasters per frame with drain(). The ancestors
+    PLACEHOLDER_LEVELS levels up are requested first, they are few, arrive first and cover the
+    view while the tiles themselves load.
+    """
+
+    def __init__(self, manager: WorldTextureManager, placeholder_levels: int = PLACEHOLDER_LEVELS):
+        self._manager = manager
+        self._placeholder_levels = placeholder_levels
+        self._arrived: 'queue.SimpleQueue[Tuple[WorldTileIndex, Optional[np.ndarray]]]' = queue.SimpleQueue()
+        self._requested = set()
+        self.pending = 0
+
+    def request(self, tiles: Iterable[WorldTileIndex]):
+        tiles = list(tiles)
+        placeholders = [self.placeholder(tile) for tile in tiles]
+        new = [tile for tile in dict.fromkeys(placeholders + tiles) if tile not in self._requested]
+        self._requested.update(new)
+        self.pending += len(new)
+        for tile, future in self._manager.load_tiles_async(new).items():
+            future.add_done_callback(partial(self._deliver, tile))
+
+    def placeholder(self, tile: WorldTileIndex) -> WorldTileIndex:
+        """Ancestor requested ahead of the tile"""
+        zoom = max(self._manager.min_zoom, tile.zoom - self._placeholder_levels)
+        level = tile.zoom - zoom
+        return WorldTileIndex(self._manager, zoom, tile.x >> level, tile.y >> level)
+
+    def _deliver(self, tile: WorldTileIndex, future):
+        # runs on the loading thread
+        raster = None if future.exception() is not None else future.result()
+        self._arrived.put((tile, raster))
+
+    def drain(self, limit: int = UPLOADS_PER_FRAME) -> List[Tuple[WorldTileIndex, np.ndarray]]:
+        """Rasters arrived since the last call, at most limit of them, failed loads are dropped"""
+        arrived = []
+        while len(arrived) < limit:
+            try:
+                tile, raster = self._arrived.get_nowait()
+            except queue.Empty:
+                break
+            self.pending -= 1
+            self._requested.discard(tile)  # a failed load can be requested again
+            if raster is not None:
+                arrived.append((tile, raster))
+        return arrived
+
+    def forget(self, tiles: Iterable[WorldTileIndex]):
+        """Lets tiles still loading be requested again, e.g. after they left the view, delivered tiles are
+        forgotten by drain()
+        """
+        self._requested.difference_update(tiles)
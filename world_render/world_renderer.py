@@ -2,10 +2,13 @@ from typing import Iterable
 import numpy as np
 
 from world_render import assets
-from world_render.geometrizer import TileGeometryBuilder, TileBuffers
+from world_render.geometrizer import CompactTileMesh, TileGeometryBuilder
+from world_render.texture_residency import TEXTURE_BUDGET, TextureResidency
+from world_render.tile_streamer import TileStreamer
 from world_render.world_textures.texture_manager import WorldTextureManager, WorldTileIndex
 
 
+
 class WorldRenderer(assets.Example):
 
     gl_version = (3, 3)
@@ -16,6 +19,16 @@ class WorldRenderer(assets.Example):
         super().__init__(**kwargs)
         self._texture_manager = WorldTextureManager()
         self._tile_builder = TileGeometryBuilder()
+        self._residency = TextureResidency(self.ctx, budget=TEXTURE_BUDGET)
+        self._streamer = TileStreamer(self._texture_manager)
+        self.prog = self.ctx.program(
+            vertex_shader=assets.ATLAS_VERTEX_SHADER,
+            fragment_shader=assets.ATLAS_FRAGMENT_SHADER,
+        )
+        self.vao = self.vbo = self.ibo = None
+        self.page_ranges = np.zeros((0, 2), dtype=np.uint32)
+        self._tiles = []
+        self._mesh: CompactTileMesh = None
 
         self.render_sample()
 
@@ -24,50 +37,55 @@ class WorldRenderer(assets.Example):
         tiles = [WorldTileIndex(self._texture_manager, 1, 2, 2),
                  WorldTileIndex(self._texture_manager, 3, 8, 9),
                  WorldTileIndex(self._texture_manager, 4, 18, 18)]
-        buffers = self._tile_builder.tesselate_tiles(tiles)
-        self._render_buffers(buffers)
-
-    def _render_buffers(self, buffers: Iterable[TileBuffers]):
-        self.prog = self.ctx.program(
-            vertex_shader=assets.VERTEX_SHADER,
-            fragment_shader=assets.FRAGMENT_SHADER,
-        )
-
-        self.vaos = []
-        self.textures = []
-        self.images = []
-        for index, buffer in enumerate(buffers):
-            assert buffer.vertices.dtype == np.float64
-            assert buffer.texcoords.dtype == np.float64
-            assert buffer.indices.dtype == np.uint16
-
-            verts = self.ctx.buffer(buffer.vertices)
-            texcos = self.ctx.buffer(buffer.texcoords)
-            inds = self.ctx.buffer(buffer.indices)
-
-            image = self._texture_manager.load_tile(buffer.tile)
-            assert image.dtype == np.uint8
-            self.images.append(image)
-            self.textures.append(self.ctx.texture(list(image.shape)[:2], image.shape[2], image.data, dtype='f1'))
-
-            # We control the 'in_vert' and `in_color' variables
-            self.vaos.append(self.ctx.vertex_array(
-                    self.prog,
-                    [
-                        # Map in_vert to the first 2 floats
-                        # Map in_color to the next 3 floats
-                        (verts, '2f8', 'in_vert'),
-                        (texcos, '2f8', 'in_tex')
-                    ],
-                    index_buffer=inds,
-                    index_element_size=2,  # 16 bit / 'u2' index buffer
-                ))
+        self._show_tiles(tiles)
+
+    def _show_tiles(self, tiles: Iterable[WorldTileIndex]):
+        """Switches the view to the tiles without waiting for them, missing textures stream in over the next frames"""
+        tiles = list(tiles)
+        self._streamer.forget(set(self._tiles).difference(tiles))  # culled, a load still running is requested again
+        self._tiles = tiles
+        self._streamer.request(tile for tile in self._tiles if tile not in self._residency.atlas)
+        self._mesh = self._tile_builder.tesselate_tiles_compact(self._tiles)
+        self._update_buffers()
+
+    def _update_buffers(self):
+        """Remaps the view mesh to the resident textures, tiles still loading use the sub-rect of an ancestor"""
+        atlas = self._residency.atlas
+        atlas.touch(self._streamer.placeholder(tile) for tile in self._tiles)
+        atlas.touch(self._tiles)
+        mesh, self.page_ranges = self._tile_builder.remap_to_atlas(self._mesh, atlas)
+
+        if self.vbo is not None and self.vbo.size == mesh.vertices.nbytes and self.ibo.size == mesh.indices.nbytes:
+            self.vbo.write(mesh.vertices)
+            self.ibo.write(mesh.indices)
+            return
+        # the previous view's buffers are released rather than piling up on the GPU
+        for resource in (self.vao, self.vbo, self.ibo):
+            if resource is not None:
+                resource.release()
+        self.vbo = self.ctx.buffer(mesh.vertices)
+        self.ibo = self.ctx.buffer(mesh.indices)
+        self.vao = self.ctx.vertex_array(
+                self.prog,
+                [(self.vbo, CompactTileMesh.VERTEX_FORMAT, 'in_vert', 'in_tex', 'in_layer')],
+                index_buffer=self.ibo,
+                index_element_size=4,  # 32 bit / 'u4' index buffer
+            )
 
     def render(self, time: float, frame_time: float):
+        # never waits on loading, only uploads what arrived since the last frame
+        arrived = self._streamer.drain()
+        for tile, raster in arrived:
+            self._residency.upload(tile, raster)
+        if arrived:
+            self._update_buffers()
+
         self.ctx.clear(1.0, 1.0, 1.0)
-        for index in range(len(self.vaos)):
-            self.textures[index].use()
-            self.vaos[index].render()
+        # one draw call per atlas page
+        for page, (first, count) in enumerate(self.page_ranges.tolist()):
+            if count:
+                self._residency.use(page)
+                self.vao.render(vertices=count, first=first)
 
 if __name__ == '__main__':
     WorldRenderer.run()
@@ -5,17 +5,68 @@ p_ll = pyproj.Proj('epsg:4326') #4326
 p_mt = pyproj.Proj('epsg:3857') # espg:3857 metric; same as EPSG:900913
 t1 = pyproj.Transformer.from_proj(p_ll, p_mt)
 t2 = pyproj.Transformer.from_proj(p_mt, p_ll)
-_ecef_to_lla = pyproj.Transformer.from_crs(
-    {"proj":'geocent', "ellps":'WGS84', "datum":'WGS84'},
-    {"proj":'latlong', "ellps":'WGS84', "datum":'WGS84'}
-    )
-_lla_to_ecef = pyproj.Transformer.from_crs(
-   {"proj":'latlong', "ellps":'WGS84', "datum":'WGS84'},
-   {"proj":'geocent', "ellps":'WGS84', "datum":'WGS84'}
-      )
+import numpy as np
+
+LLA_CRS = {"proj": 'latlong', "ellps": 'WGS84', "datum": 'WGS84'}
+ECEF_CRS = {"proj": 'geocent', "ellps": 'WGS84', "datum": 'WGS84'}
+
+_transformers = {}
+
+
+def _crs_key(crs):
+    return tuple(sorted(crs.items())) if isinstance(crs, dict) else crs
+
+
+def get_transformer(crs_from, crs_to) -> pyproj.Transformer:
+    """One transformer per CRS pair for the whole process, building one costs far more than a batch transform.
+    Axis order is always x/lon first.
+    """
+    key = (_crs_key(crs_from), _crs_key(crs_to))
+    transformer = _transformers.get(key)
+    if transformer is None:
+        transformer = pyproj.Transformer.from_crs(crs_from, crs_to, always_xy=True)
+        _transformers[key] = transformer
+    return transformer
+
+
+def transform(crs_from, crs_to, *coords):
+    """Transforms whole coordinate arrays in a single call"""
+    return get_transformer(crs_from, crs_to).transform(*(np.asarray(c, dtype=np.float64) for c in coords))
+
+
+_ecef_to_lla = get_transformer(ECEF_CRS, LLA_CRS)
+_lla_to_ecef = get_transformer(LLA_CRS, ECEF_CRS)
 
 def ecef_to_lla(x,y,z):
     return _ecef_to_lla.transform(x,y,z,radians=False)
 
 def lla_to_ecef(lon, lat, alt=0):
-    return _lla_to_ecef.transform(lon, lat, alt,radians=False)
\ No newline at end of file
+    return _lla_to_ecef.transform(lon, lat, alt,radians=False)
+
+
+def lla_to_ecef_array(lon, lat, alt=0) -> np.ndarray:
+    """(..., 3) ECEF of broadcast lon/lat/alt arrays"""
+    lon, lat, alt = np.broadcast_arrays(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64),
+                                        np.asarray(alt, dtype=np.float64))
+    return np.stack(_lla_to_ecef.transform(lon.ravel(), lat.ravel(), alt.ravel()), axis=-1).reshape(lon.shape + (3,))
+
+
+def ecef_to_lla_array(ecef: np.ndarray) -> np.ndarray:
+    """(..., 3) lon, lat, alt of (..., 3) ECEF positions"""
+    ecef = np.asarray(ecef, dtype=np.float64)
+    flat = ecef.reshape(-1, 3)
+    return np.stack(_ecef_to_lla.transform(flat[:, 0], flat[:, 1], flat[:, 2]), axis=-1).reshape(ecef.shape)
+
+
+def enu_rotation(lon: float, lat: float) -> np.ndarray:
+    """Rows are the east, north and up axes of the local tangent plane in ECEF"""
+    lon, lat = np.radians(lon), np.radians(lat)
+    return np.array([[-np.sin(lon), np.cos(lon), 0],
+                     [-np.sin(lat) * np.cos(lon), -np.sin(lat) * np.sin(lon), np.cos(lat)],
+                     [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)]])
+
+
+def ecef_to_enu(ecef: np.ndarray, lon: float, lat: float, alt: float = 0) -> np.ndarray:
+    """(..., 3) east, north, up meters of ECEF positions around the origin lon/lat/alt"""
+    origin = lla_to_ecef_array(lon, lat, alt)
+    return (np.asarray(ecef, dtype=np.float64) - origin) @ enu_rotation(lon, lat).T
@@ -0,0 +1,53 @@
+import enum
+from typing import Optional, Sequence
+
+import numpy as np
+
+from world_render.world_textures.raster_cache import RasterCache
+from world_render.world_textures.tile_codec import EncodedTile, TileDecoder, encode_tile
+
+ENCODE_FORMATS = {'image/jpeg': 'JPEG'}  # anything else is written as PNG
+
+
+class DerivedPolicy(enum.Enum):
+    """When load_tile() synthesizes a missing tile from its cached children"""
+    PREFER = 'prefer'  # before going to the source, a zoom out never refetches what the cache can build
+    FALLBACK = 'fallback'  # only when the source doesn't have the tile or the fetch failed
+    NEVER = 'never'
+
+
+def downsample_children(children: Sequence[np.ndarray]) -> np.ndarray:
+    """Parent raster of the four child rasters given in get_children() order, bl, br, tl, tr.
+
+    Grid y grows with the raster rows, so the first two children are the top half. Every parent pixel
+    is the rounded mean of its 2x2 child pixels.
+    """
+    channels = max(child.shape[2] for child in children)
+    if channels == 4:
+        children = [child if child.shape[2] == 4 else
+                    np.concatenate([child, np.full(child.shape[:2] + (1,), 255, dtype=np.uint8)], axis=2)
+                    for child in children]
+    mosaic = np.concatenate([np.concatenate(children[0:2], axis=1), np.concatenate(children[2:4], axis=1)], axis=0)
+    height, width = mosaic.shape[0] // 2, mosaic.shape[1] // 2
+    blocks = mosaic.reshape(height, 2, width, 2, channels).astype(np.uint16).sum(axis=(1, 3))
+    return ((blocks + 2) >> 2).astype(np.uint8)
+
+
+def synthesize_tile(tile, cache: RasterCache = None, check_disk: bool = False) -> Optional[EncodedTile]:
+    """Builds the tile from its four cached children, None unless all of them are cached.
+    Never goes to the source, the result is tagged derived and isn't put in the cache.
+    check_disk finds children other processes cached since this one started, see RasterCache.get_encoded().
+    """
+    cache = cache or RasterCache.instance()
+    encoded_children = []
+    for child in tile.get_children():
+        encoded = cache.get_encoded(child.cache_key, check_disk)
+        if encoded is None:
+            return None
+        encoded_children.append(encoded)
+    decoder = TileDecoder.instance()
+    children = [future.result() for future in [decoder.submit(encoded) for encoded in encoded_children]]
+    raster = downsample_children(children)
+    encoded = encode_tile(raster, ENCODE_FORMATS.get(encoded_children[0].content_type, 'PNG'))
+    encoded.derived = True
+    return encoded
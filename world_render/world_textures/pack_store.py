@@ -0,0 +1,302 @@
+import mmap
+import os
+import socket
+import threading
+from typing import Optional, Tuple
+
+import numpy as np
+
+from world_render.world_textures.tile_codec import EncodedTile, decode_tile
+
+INDEX_SUFFIX = '.idx.npz'
+LOCK_SUFFIX = '.lock'
+
+
+class PackStore:
+    """Offline tile store, raw fixed size tile slots appended to a pack file and read through mmap.
+
+    get() returns read only numpy views into the mapping, no unpickling, copying or decoding involved.
+    The index (quadkeys sorted next to their slots) is replaced atomically on flush(), so any number of
+    reader processes can share the store with a single writer. Readers pick up new tiles on refresh(),
+    which a get() miss does by itself. Compaction writes the live slots into a new pack generation in
+    quadkey order, readers keep using the old generation until they refresh. Within a process the
+    index and the mapping are swapped under a lock, so get() can be called from any thread.
+    The writer lock file holds the pid and host of the writer, a lock left by a dead writer is broken.
+    """
+
+    def __init__(self, path: str, layer_name: str = None, tile_size: int = 256, channels: int = 4,
+                 writable: bool = False):
+        self._path = path
+        self._writable = writable
+        self._lock_fd = None
+        self._mmap: Optional[mmap.mmap] = None
+        self._pack_file = None
+        self._index_mtime = None
+        self._pending = {}
+        self._lock = threading.RLock()
+        if writable:
+            self._lock_fd = self._acquire_writer_lock(path + LOCK_SUFFIX)
+        if os.path.exists(path + INDEX_SUFFIX):
+            self._load_index()
+            if layer_name is not None and layer_name != self.layer_name:
+                raise ValueError(f'pack {path} holds layer {self.layer_name} not {layer_name}')
+        elif writable:
+            if layer_name is None:
+                raise ValueError('layer_name is required to create a pack')
+            self.layer_name, self.tile_size, self.channels, self._generation = layer_name, tile_size, channels, 0
+            self._quadkeys = np.zeros(0, dtype=np.uint64)
+            self._slots = np.zeros(0, dtype=np.uint64)
+            self._write_index()
+            self._open_pack()
+        else:
+            raise FileNotFoundError(path + INDEX_SUFFIX)
+
+    @staticmethod
+    def _acquire_writer_lock(lock_path: str) -> int:
+        owner = f'{os.getpid()} {socket.gethostname()}'
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not _is_stale_lock(lock_path):
+                raise
+            # two writers breaking the same stale lock at once can't both get past the O_EXCL below
+            try:
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        os.write(fd, owner.encode())
+        return fd
+
+    @property
+    def slot_shape(self) -> Tuple[int, int, int]:
+        return self.tile_size, self.tile_size, self.channels
+
+    @property
+    def slot_size(self) -> int:
+        return self.tile_size * self.tile_size * self.channels
+
+    def _pack_path(self, generation: int):
+        return f'{self._path}.{generation}.pack'
+
+    def _load_index(self):
+        self._index_mtime = os.stat(self._path + INDEX_SUFFIX).st_mtime_ns
+        with np.load(self._path + INDEX_SUFFIX) as index:
+            self.layer_name = str(index['layer_name'])
+            self.tile_size, self.channels, self._generation = (int(value) for value in index['header'])
+            self._quadkeys = index['quadkeys']
+            self._slots = index['slots']
+        self._open_pack()
+
+    def _write_index(self):
+        tmp_path = self._path + INDEX_SUFFIX + '.tmp'
+        with open(tmp_path, 'wb') as out:
+            np.savez(out, layer_name=np.array(self.layer_name),
+                     header=np.array([self.tile_size, self.channels, self._generation], dtype=np.int64),
+                     quadkeys=self._quadkeys, slots=self._slots)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, self._path + INDEX_SUFFIX)
+        self._index_mtime = os.stat(self._path + INDEX_SUFFIX).st_mtime_ns
+
+    def _open_pack(self):
+        self._close_pack()
+        pack_path = self._pack_path(self._generation)
+        if self._writable:
+            self._pack_file = open(pack_path, 'ab')
+        self._remap()
+
+    def _remap(self):
+        # views handed out by get() keep the old mapping alive, it is unmapped once they are all released
+        self._mmap = None
+        pack_path = self._pack_path(self._generation)
+        if os.path.exists(pack_path) and os.path.getsize(pack_path):
+            with open(pack_path, 'rb') as pack:
+                self._mmap = mmap.mmap(pack.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close_pack(self):
+        self._mmap = None
+        if self._pack_file is not None:
+            self._pack_file.close()
+            self._pack_file = None
+
+    def refresh(self):
+        """Reloads the index if another process flushed or compacted the store"""
+        with self._lock:
+            if os.stat(self._path + INDEX_SUFFIX).st_mtime_ns != self._index_mtime:
+                self._load_index()
+
+    def _find_slot(self, quadkey: int) -> Optional[int]:
+        if quadkey in self._pending:
+            return self._pending[quadkey]
+        pos = np.searchsorted(self._quadkeys, quadkey)
+        if pos < len(self._quadkeys) and self._quadkeys[pos] == quadkey:
+            return int(self._slots[pos])
+        return None
+
+    def __contains__(self, quadkey: int):
+        with self._lock:
+            return self._find_slot(quadkey) is not None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._quadkeys) + len(self._pending)
+
+    def _is_mapped(self, slot: int) -> bool:
+        return self._mmap is not None and (slot + 1) * self.slot_size <= len(self._mmap)
+
+    def get(self, quadkey: int) -> Optional[np.ndarray]:
+        with self._lock:
+            slot = self._find_slot(quadkey)
+            if slot is None and not self._writable:
+                self.refresh()
+                slot = self._find_slot(quadkey)
+            if slot is None:
+                return None
+            if not self._is_mapped(slot):
+                if self._pack_file is not None:
+                    self._pack_file.flush()
+                self._remap()  # the slot was appended after the pack was mapped
+            if not self._is_mapped(slot) and not self._writable:
+                # the generation of the loaded index was compacted away since, the new index points to the next one
+                self.refresh()
+                slot = self._find_slot(quadkey)
+            if slot is None or not self._is_mapped(slot):
+                return None
+            # the view keeps its mapping alive, a later swap doesn't invalidate it
+            return np.frombuffer(self._mmap, dtype=np.uint8, count=self.slot_size,
+                                 offset=slot * self.slot_size).reshape(self.slot_shape)
+
+    def _to_slot(self, raster: np.ndarray) -> np.ndarray:
+        if raster.shape[:2] != (self.tile_size, self.tile_size):
+            raise ValueError(f'tile of shape {raster.shape} does not fit a {self.slot_shape} slot')
+        if raster.shape[2] == self.channels:
+            return raster
+        if self.channels == 4:
+            alpha = np.full(raster.shape[:2] + (1,), 255, dtype=np.uint8)
+            return np.concatenate([raster, alpha], axis=2)
+        return raster[:, :, :self.channels]
+
+    def put(self, quadkey: int, raster: np.ndarray):
+        """Appends the tile in a new slot, a replaced tile leaves a dead slot until compact()"""
+        if not self._writable:
+            raise PermissionError(f'pack {self._path} is opened read only')
+        data = np.ascontiguousarray(self._to_slot(raster), dtype=np.uint8).tobytes()
+        with self._lock:
+            self._pending[quadkey] = self._pack_file.tell() // self.slot_size
+            self._pack_file.write(data)
+
+    def flush(self):
+        """Makes the appended tiles visible to other readers"""
+        with self._lock:
+            if not self._pending:
+                return
+            self._pack_file.flush()
+            os.fsync(self._pack_file.fileno())
+            quadkeys = np.fromiter(self._pending.keys(), dtype=np.uint64, count=len(self._pending))
+            slots = np.fromiter(self._pending.values(), dtype=np.uint64, count=len(self._pending))
+            keep = ~np.isin(self._quadkeys, quadkeys)
+            quadkeys = np.concatenate([self._quadkeys[keep], quadkeys])
+            slots = np.concatenate([self._slots[keep], slots])
+            order = np.argsort(quadkeys, kind='stable')
+            self._quadkeys, self._slots = quadkeys[order], slots[order]
+            self._pending = {}
+            self._write_index()
+
+    def compact(self):
+        """Rewrites the live slots in quadkey order to a new pack generation, dropping dead slots"""
+        with self._lock:
+            self.flush()
+            old_pack_path = self._pack_path(self._generation)
+            self._remap()
+            with open(self._pack_path(self._generation + 1), 'wb') as out:
+                for slot in self._slots:
+                    out.write(self._mmap[int(slot) * self.slot_size:(int(slot) + 1) * self.slot_size])
+                out.flush()
+                os.fsync(out.fileno())
+            self._generation += 1
+            self._slots = np.arange(len(self._quadkeys), dtype=np.uint64)
+            self._write_index()
+            self._open_pack()
+        try:
+            os.remove(old_pack_path)
+        except OSError:
+            pass  # still mapped by a reader on platforms that don't allow removing it
+
+    def close(self):
+        if self._writable:
+            self.flush()
+        with self._lock:
+            self._close_pack()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            os.remove(self._path + LOCK_SUFFIX)
+            self._lock_fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _is_stale_lock(lock_path: str) -> bool:
+    """True if the writer lock was left by a writer of this host that is no longer running"""
+    try:
+        with open(lock_path) as lock_file:
+            pid, host = lock_file.read().split(' ', 1)
+    except (OSError, ValueError):
+        return False  # gone already, or the writer hasn't written its pid yet
+    return host == socket.gethostname() and not _is_process_alive(int(pid))
+
+
+def _is_process_alive(pid: int) -> bool:
+    if os.name == 'nt':
+        # os.kill() terminates the process on windows, ask for its exit code instead
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        exit_code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        kernel32.CloseHandle(handle)
+        return exit_code.value == 259  # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # running as another user
+    return True
+
+
+def build_pack_from_diskcache(cache_dir: str, path: str, layer_name: str,
+                              tile_size: int = 256, channels: int = 4) -> int:
+    """Converts the tiles of a layer in a RasterCache directory into a pack, returns the number of tiles"""
+    import diskcache
+    cache = diskcache.FanoutCache(cache_dir)
+    count = 0
+    with PackStore(path, layer_name, tile_size, channels, writable=True) as store:
+        for key in cache:
+            if not (isinstance(key, tuple) and len(key) == 2 and key[0] == layer_name):
+                continue
+            encoded = cache.get(key)
+            if isinstance(encoded, EncodedTile):
+                store.put(key[1], decode_tile(encoded))
+                count += 1
+        store.compact()
+    return count
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Builds a tile pack from a raster cache directory')
+    parser.add_argument('cache_dir')
+    parser.add_argument('pack_path')
+    parser.add_argument('layer_name')
+    parser.add_argument('--tile-size', type=int, default=256)
+    parser.add_argument('--channels', type=int, default=4)
+    args = parser.parse_args()
+    print(build_pack_from_diskcache(args.cache_dir, args.pack_path, args.layer_name, args.tile_size, args.channels),
+          'tiles packed')
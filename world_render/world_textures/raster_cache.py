@@ -1,12 +1,115 @@
-from typing import Hashable
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Hashable, Optional
 
 import diskcache
+import numpy as np
+
+from world_render.world_textures.tile_codec import EncodedTile, TileDecoder, encode_tile
+from world_render.world_textures.tile_fetcher import BACKOFF_FACTOR, MAX_RETRIES, REQUEST_TIMEOUT
 # TODO fix
 CACHE_DIR = "C:\Temp\GpuCache"
 CACHE_SIZE = 2 ** 27  # 128meg
-LOCK_EXPIRATION = 2 * 60 # 2 minutes
+MEMORY_CACHE_SIZE = 2 ** 28  # 256meg of decoded rasters
+# a key lock outlives the slowest fetch under it, every attempt timing out after its backoff, with a minute to spare
+LOCK_EXPIRATION = (MAX_RETRIES + 1) * REQUEST_TIMEOUT + BACKOFF_FACTOR * (2 ** MAX_RETRIES - 1) + 60
 DATA_EXPIRATION = 10*24*60*60 # 10 days
+STALE_EXPIRATION = 30*24*60*60 # expired entries are still served this long while they get revalidated
+REVALIDATE_WORKERS = 4
+PRESENCE_CAPACITY = 2 ** 20  # expected number of cached tiles
+PRESENCE_BITS_PER_KEY = 10  # ~1% false positives
+PRESENCE_HASHES = 7
+LOCK_KEY = 'raster-lock'
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryLRU:
+    """Process local LRU of decoded rasters bounded by their total byte size"""
+
+    def __init__(self, size_limit: int = MEMORY_CACHE_SIZE):
+        self._items = OrderedDict()
+        self._size_limit = size_limit
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value):
+        nbytes = getattr(value, 'nbytes', 0)
+        if value is None or nbytes > self._size_limit:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= old.nbytes
+            self._items[key] = value
+            self._size += nbytes
+            while self._size > self._size_limit:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= evicted.nbytes
+                self.evictions += 1
+
+    def __contains__(self, key: Hashable):
+        """Presence check only, doesn't count as a hit or a miss and leaves the LRU order alone"""
+        with self._lock:
+            return key in self._items
+
+    def discard(self, key: Hashable):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= old.nbytes
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    count=len(self._items), size=self._size, size_limit=self._size_limit)
+
+
+class PresenceIndex:
+    """Bloom filter of the cached keys, a negative answer means the key is certainly not on disk"""
+
+    def __init__(self, capacity: int = PRESENCE_CAPACITY):
+        self._num_bits = capacity * PRESENCE_BITS_PER_KEY
+        self._bits = np.zeros((self._num_bits + 7) // 8, dtype=np.uint8)
+
+    def _positions(self, key: Hashable):
+        h1 = hash(key)
+        h2 = hash((key, PRESENCE_HASHES)) | 1
+        return [(h1 + i * h2) % self._num_bits for i in range(PRESENCE_HASHES)]
+
+    def add(self, key: Hashable):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: Hashable):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
 class RasterCache:
+    """Two tier cache, an in memory LRU of decoded rasters in front of a diskcache directory of encoded tiles
+    shared between processes.
+
+    Keys should be compact and stable (see WorldTileIndex.cache_key), they are pickled on every disk access.
+    A presence index loaded at startup lets get() skip the disk for known misses, get_or_load() always
+    checks the disk again under the key lock since other processes may have written the key since.
+    Entries older than DATA_EXPIRATION are stale, loads still return them at once and revalidate
+    them in the background, a tile that didn't change only gets its time to live refreshed.
+    """
     _instance: 'RasterCache' = None
 
     @classmethod
@@ -15,16 +118,198 @@ class RasterCache:
             cls._instance = RasterCache()
         return cls._instance
 
-    def __init__(self):
+    def __init__(self, memory_size: int = MEMORY_CACHE_SIZE):
         self._cache = diskcache.FanoutCache(CACHE_DIR, size_limit=int(CACHE_SIZE))
+        self._memory = MemoryLRU(memory_size)
+        self._decoder = TileDecoder.instance()
+        self._disk_hits = 0
+        self._disk_misses = 0
+        self._disk_skips = 0
+        self._disk_writes = 0
+        self._disk_initial_count = len(self._cache)
+        self._revalidator: ThreadPoolExecutor = None
+        self._revalidating = set()
+        self._lock = threading.Lock()
+        self._revalidations = 0
+        self._not_modified = 0
+        self._revalidation_failures = 0
+        self._presence = PresenceIndex()
+        for key in self._cache:
+            if not (isinstance(key, tuple) and key and key[0] == LOCK_KEY):
+                self._presence.add(key)
+
+    def add_presence(self, key: Hashable):
+        """Records a key another process wrote, the presence index only sees writes of this process"""
+        self._presence.add(key)
 
     def lock(self, key: Hashable):
-        return diskcache.Lock(self._cache, LOCK_EXPIRATION)
+        """Cross process lock of a single key, held locks expire so a crashed holder can't block the key forever"""
+        return diskcache.Lock(self._cache, (LOCK_KEY, key), expire=LOCK_EXPIRATION)
+
+    def __contains__(self, key: Hashable):
+        return key in self._memory or (key in self._presence and key in self._cache)
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Optional[EncodedTile]],
+                    revalidate: Callable[[EncodedTile], Optional[EncodedTile]] = None):
+        """Single flight load, concurrent callers of the same key in all processes wait for one loader call.
+        revalidate checks a stale entry against its source, see _revalidate(), without it stale entries are kept.
+        """
+        value = self._memory.get(key)
+        if value is not None:
+            return value
+        encoded = self.load_encoded(key, loader)
+        if encoded is None:
+            return None
+        value = self._decode(key, encoded)
+        # only after the decode, a revalidation that changed the tile must not be overwritten by the stale raster
+        self._revalidate_if_stale(key, encoded, revalidate)
+        return value
+
+    def load_encoded(self, key: Hashable, loader: Callable[[], Optional[EncodedTile]],
+                     revalidate: Callable[[EncodedTile], Optional[EncodedTile]] = None) -> Optional[EncodedTile]:
+        """Same single flight load as get_or_load() without decoding, for callers that only fill the cache"""
+        encoded = self.get_encoded(key)
+        if encoded is None:
+            with self.lock(key):
+                # a concurrent loader may have finished while we waited, the presence index can't know about it
+                encoded = self._cache.get(key)
+                if encoded is not None:
+                    self._disk_hits += 1
+                else:
+                    encoded = loader()
+                    if encoded is not None:
+                        self.put(key, encoded)
+        self._revalidate_if_stale(key, encoded, revalidate)
+        return encoded
+
+    @staticmethod
+    def is_stale(encoded: EncodedTile) -> bool:
+        return time.time() - encoded.validated_at > DATA_EXPIRATION
+
+    def _revalidate_if_stale(self, key: Hashable, encoded: Optional[EncodedTile],
+                             revalidate: Callable[[EncodedTile], Optional[EncodedTile]]):
+        if encoded is None or revalidate is None or not self.is_stale(encoded):
+            return
+        with self._lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+            if self._revalidator is None:
+                self._revalidator = ThreadPoolExecutor(max_workers=REVALIDATE_WORKERS,
+                                                       thread_name_prefix='tile-revalidator')
+        self._revalidator.submit(self._revalidate, key, encoded, revalidate)
+
+    def _revalidate(self, key: Hashable, encoded: EncodedTile,
+                    revalidate: Callable[[EncodedTile], Optional[EncodedTile]]):
+        # revalidate returns encoded itself if the source still has it, the new tile if it changed
+        # and None if the source couldn't tell, the stale entry is kept then
+        try:
+            fresh = revalidate(encoded)
+            if fresh is None:
+                self._revalidation_failures += 1
+                return
+            if fresh is encoded:
+                self._not_modified += 1
+            else:
+                self._memory.discard(key)
+            self.put(key, fresh)
+            self._revalidations += 1
+        except Exception:
+            # nobody waits on the future, the stale entry is kept and retried on the next load
+            self._revalidation_failures += 1
+            logger.exception('revalidation of %s failed', key)
+        finally:
+            with self._lock:
+                self._revalidating.discard(key)
+
+    @property
+    def revalidating(self) -> int:
+        """Revalidations still running"""
+        return len(self._revalidating)
 
     def get(self, key: Hashable):
-        return self._cache.get(key)
+        """Decoded raster of the key, disk hits are decoded on the decoder pool and promoted to memory"""
+        value = self._memory.get(key)
+        if value is not None:
+            return value
+        encoded = self.get_encoded(key)
+        return None if encoded is None else self._decode(key, encoded)
 
-    def put(self, key: Hashable, value):
-        return self._cache.set(key, value, expire=DATA_EXPIRATION)
+    def get_encoded(self, key: Hashable, check_disk: bool = False) -> Optional[EncodedTile]:
+        """check_disk reads the disk even for keys the presence index doesn't know, for keys written by other processes"""
+        if not check_disk and key not in self._presence:
+            self._disk_skips += 1
+            return None
+        encoded = self._cache.get(key)
+        if encoded is None:
+            self._disk_misses += 1
+        else:
+            self._disk_hits += 1
+        return encoded
+
+    def _decode(self, key: Hashable, encoded: EncodedTile):
+        value = self._decoder.decode(encoded)
+        self._memory.put(key, value)
+        return value
+
+    def put(self, key: Hashable, encoded: EncodedTile, raster: np.ndarray = None):
+        """Writes the encoded tile to disk as freshly validated, the raster if already decoded goes straight to
+        the memory tier
+        """
+        if raster is not None:
+            self._memory.put(key, raster)
+        encoded.validated_at = time.time()
+        self._presence.add(key)
+        self._disk_writes += 1
+        return self._cache.set(key, encoded, expire=DATA_EXPIRATION + STALE_EXPIRATION)
+
+    def stats(self):
+        """Hit/miss/eviction counters per tier, disk evictions count entries culled or expired since startup"""
+        disk_count = len(self._cache)
+        disk_evictions = max(0, self._disk_initial_count + self._disk_writes - disk_count)
+        return dict(memory=self._memory.stats(),
+                    disk=dict(hits=self._disk_hits, misses=self._disk_misses, skips=self._disk_skips,
+                              evictions=disk_evictions,
+                              count=disk_count, size=self._cache.volume(), size_limit=int(CACHE_SIZE)),
+                    revalidation=dict(done=self._revalidations, not_modified=self._not_modified,
+                                      failed=self._revalidation_failures, running=self.revalidating))
+
+
+def _stress_worker(args):
+    cache_dir, keys, fetch_delay = args
+    global CACHE_DIR
+    CACHE_DIR = cache_dir
+    cache = RasterCache()
+    loads = []
+    tile = encode_tile(np.zeros((1, 1, 3), dtype=np.uint8))
+
+    def loader(key):
+        time.sleep(fetch_delay)  # stands in for the network fetch
+        loads.append(key)
+        return tile
+
+    start = time.perf_counter()
+    for key in keys:
+        cache.get_or_load(key, lambda key=key: loader(key))
+    return len(loads), time.perf_counter() - start
+
+
+def _stress_lock_scaling(tiles_per_worker: int = 40, fetch_delay: float = 0.02):
+    """Distinct keys should scale with the worker count, shared keys should be loaded exactly once"""
+    import multiprocessing
+    import tempfile
+    for workers in (1, 2, 4, 8):
+        with tempfile.TemporaryDirectory() as cache_dir, multiprocessing.Pool(workers) as pool:
+            jobs = [(cache_dir, [('distinct', worker, i) for i in range(tiles_per_worker)], fetch_delay)
+                    for worker in range(workers)]
+            loads, elapsed = zip(*pool.map(_stress_worker, jobs))
+            print(f'{workers} workers, distinct keys: {sum(loads) / max(elapsed):8.1f} tiles/s')
+
+        with tempfile.TemporaryDirectory() as cache_dir, multiprocessing.Pool(workers) as pool:
+            jobs = [(cache_dir, [('shared', i) for i in range(tiles_per_worker)], fetch_delay)] * workers
+            loads, _ = zip(*pool.map(_stress_worker, jobs))
+            print(f'{workers} workers, shared keys: {sum(loads)} loads for {tiles_per_worker} keys')
 
 
+if __name__ == '__main__':
+    _stress_lock_scaling()
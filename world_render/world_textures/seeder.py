@@ -0,0 +1,288 @@
+import dataclasses
+import hashlib
+import json
+import math
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from shapely.geometry import box, shape
+from shapely.geometry.base import BaseGeometry
+from shapely.ops import unary_union
+from shapely.prepared import prep
+
+import world_render.world_textures.raster_cache as raster_cache
+from world_render.world_textures.overviews import synthesize_tile
+from world_render.world_textures.raster_cache import RasterCache
+from world_render.world_textures.tile_codec import TileDecoder
+from world_render.world_textures.texture_manager import WorldTextureManager, WorldTileIndex
+
+SEED_WORKERS = 8
+OVERVIEW_PROCESSES = os.cpu_count() or 4
+CHECKPOINT_INTERVAL = 5  # seconds
+REPORT_INTERVAL = 5  # seconds
+
+
+@dataclasses.dataclass
+class SeedStats:
+    fetched: int = 0
+    skipped: int = 0  # already cached
+    failed: int = 0
+    bytes: int = 0
+    elapsed: float = 0
+
+    @property
+    def tiles_per_second(self):
+        return (self.fetched + self.skipped) / self.elapsed if self.elapsed else 0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.elapsed if self.elapsed else 0
+
+    def __str__(self):
+        return (f'{self.fetched} fetched, {self.skipped} cached, {self.failed} failed, '
+                f'{self.tiles_per_second:.1f} tiles/s, {self.bytes_per_second / 1024:.1f} KB/s')
+
+
+def load_geojson(path: str) -> BaseGeometry:
+    """Union of all the geometries in a GeoJSON file"""
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('type') == 'FeatureCollection':
+        return unary_union([shape(feature['geometry']) for feature in data['features']])
+    if data.get('type') == 'Feature':
+        return shape(data['geometry'])
+    return shape(data)
+
+
+def zoom_for_mpp(manager: WorldTextureManager, mpp: float, lon: float, lat: float) -> int:
+    """Lowest zoom whose tile at lon/lat has at least the given meter per pixel resolution"""
+    for zoom in range(manager.min_zoom, manager.max_zoom):
+        x, y = manager.wgs84lla_to_grid(zoom, lon, lat)
+        if WorldTileIndex(manager, zoom, int(x), int(y)).mpp <= mpp:
+            return zoom
+    return manager.max_zoom
+
+
+def iter_area_rows(manager: WorldTextureManager, area: BaseGeometry, zoom: int) \
+        -> Iterator[Tuple[int, Iterator[WorldTileIndex]]]:
+    """Streams the tiles of a zoom level touching the area, one grid row at a time"""
+    prepared = prep(area)
+    min_lon, min_lat, max_lon, max_lat = area.bounds
+    corners = [manager.wgs84lla_to_grid(zoom, min_lon, min_lat), manager.wgs84lla_to_grid(zoom, max_lon, max_lat)]
+    last = 2 ** zoom - 1
+    y_from, y_to = (max(0, min(last, int(math.floor(f([c[1] for c in corners]))))) for f in (min, max))
+    for y in range(y_from, y_to + 1):
+        row_bounds = WorldTileIndex(manager, zoom, 0, y).world_bbox
+        row = area.intersection(box(min_lon, row_bounds[1], max_lon, row_bounds[3]))
+        if row.is_empty:
+            continue
+        row_min_x = manager.wgs84lla_to_grid(zoom, row.bounds[0], row_bounds[1])[0]
+        row_max_x = manager.wgs84lla_to_grid(zoom, row.bounds[2], row_bounds[1])[0]
+        xs = range(max(0, int(math.floor(row_min_x))), min(last, int(math.floor(row_max_x))) + 1)
+        yield y, (tile for tile in (WorldTileIndex(manager, zoom, x, y) for x in xs)
+                  if prepared.intersects(box(*tile.world_bbox)))
+
+
+class RegionSeeder:
+    """Warms the raster cache for an area over a zoom range.
+
+    Tiles are fetched on a bounded pool, cached tiles are skipped, and the grid rows that are complete
+    are checkpointed to a state file so an interrupted run resumes where it stopped.
+    """
+
+    def __init__(self, manager: WorldTextureManager, area: BaseGeometry, zooms: Tuple[int, int],
+                 state_path: str = None, workers: int = SEED_WORKERS,
+                 report: Callable[[SeedStats], None] = None):
+        self._manager = manager
+        self._area = area
+        self._zooms = zooms
+        self._state_path = state_path
+        self._workers = workers
+        self._report = report or (lambda stats: print(stats))
+        self.stats = SeedStats()
+        self._done_rows: Dict[int, Set[int]] = self._load_state()
+
+    @classmethod
+    def for_mpp_range(cls, manager: WorldTextureManager, area: BaseGeometry, mpp_range: Tuple[float, float],
+                      **kwargs):
+        """mpp_range is (finest, coarsest) meter per pixel, measured at the area centroid"""
+        center = area.centroid
+        zooms = (zoom_for_mpp(manager, max(mpp_range), center.x, center.y),
+                 zoom_for_mpp(manager, min(mpp_range), center.x, center.y))
+        return cls(manager, area, zooms, **kwargs)
+
+    @property
+    def _run_id(self):
+        run = f'{self._manager.layer_name}|{self._zooms}|{self._area.wkb_hex}'
+        return hashlib.sha1(run.encode()).hexdigest()
+
+    def _load_state(self) -> Dict[int, Set[int]]:
+        if not self._state_path or not os.path.exists(self._state_path):
+            return {}
+        with open(self._state_path) as f:
+            state = json.load(f)
+        if state.get('run') != self._run_id:
+            return {}  # progress of a different area or zoom range
+        return {int(zoom): set(rows) for zoom, rows in state['rows'].items()}
+
+    def _save_state(self):
+        if not self._state_path:
+            return
+        tmp_path = self._state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'run': self._run_id, 'rows': {zoom: sorted(rows) for zoom, rows in self._done_rows.items()}}, f)
+        os.replace(tmp_path, self._state_path)
+
+    def _seed_tile(self, tile: WorldTileIndex, cache: RasterCache) -> Optional[int]:
+        """Returns the fetched bytes, 0 if it was already cached and None if the fetch failed"""
+        if tile.cache_key in cache:
+            return 0
+        encoded = self._manager.load_encoded_tile(tile)
+        return None if encoded is None else encoded.nbytes
+
+    def run(self) -> SeedStats:
+        cache = RasterCache.instance()
+        start = last_report = last_checkpoint = time.perf_counter()
+        row_pending: Dict[Tuple[int, int], int] = {}
+        rows_enumerated = set()
+        rows_failed = set()  # rows with failed tiles are retried on resume
+        in_flight = {}
+
+        def complete(future):
+            row = in_flight.pop(future)
+            try:
+                nbytes = future.result()
+            except Exception:  # e.g. a broken response or a corrupt child in synthesis, only fails this tile
+                nbytes = None
+            if nbytes is None:
+                self.stats.failed += 1
+                rows_failed.add(row)
+            elif nbytes == 0:
+                self.stats.skipped += 1
+            else:
+                self.stats.fetched += 1
+                self.stats.bytes += nbytes
+            row_pending[row] -= 1
+            if not row_pending[row] and row in rows_enumerated:
+                del row_pending[row]
+                if row not in rows_failed:
+                    self._done_rows[row[0]].add(row[1])
+
+        # the finally keeps the rows done since the last checkpoint when the run fails or is interrupted
+        try:
+            with ThreadPoolExecutor(max_workers=self._workers) as executor:
+                for zoom in range(self._zooms[0], self._zooms[1] + 1):
+                    done_rows = self._done_rows.setdefault(zoom, set())
+                    for y, tiles in iter_area_rows(self._manager, self._area, zoom):
+                        if y in done_rows:
+                            continue
+                        row = (zoom, y)
+                        row_pending[row] = 0
+                        for tile in tiles:
+                            while len(in_flight) >= 2 * self._workers:
+                                for future in wait(in_flight, return_when=FIRST_COMPLETED).done:
+                                    complete(future)
+                            row_pending[row] += 1
+                            in_flight[executor.submit(self._seed_tile, tile, cache)] = row
+                        rows_enumerated.add(row)
+                        if not row_pending[row]:
+                            del row_pending[row]
+                            if row not in rows_failed:
+                                done_rows.add(y)
+
+                        now = time.perf_counter()
+                        self.stats.elapsed = now - start
+                        if now - last_checkpoint > CHECKPOINT_INTERVAL:
+                            self._save_state()
+                            last_checkpoint = now
+                        if now - last_report > REPORT_INTERVAL:
+                            self._report(self.stats)
+                            last_report = now
+                for future in wait(in_flight).done:
+                    complete(future)
+        finally:
+            self.stats.elapsed = time.perf_counter() - start
+            self._save_state()
+        self._report(self.stats)
+        return self.stats
+
+
+def seed_region(manager: WorldTextureManager, area: BaseGeometry, zooms: Tuple[int, int] = None,
+                mpp_range: Tuple[float, float] = None, **kwargs) -> SeedStats:
+    if zooms is None:
+        return RegionSeeder.for_mpp_range(manager, area, mpp_range, **kwargs).run()
+    return RegionSeeder(manager, area, zooms, **kwargs).run()
+
+
+def _init_overview_worker(cache_dir: str):
+    # a forked worker inherits the singletons of the parent, the pool threads of its decoder don't exist in the
+    # child and a decode would wait on them forever, a spawned one would miss a CACHE_DIR set at runtime
+    raster_cache.CACHE_DIR = cache_dir
+    RasterCache._instance = None
+    TileDecoder._instance = None
+
+
+def _build_overview_row(layer_name: str, zoom: int, xs: List[int], y: int) -> List[int]:
+    # runs in the pool processes, cache keys only depend on the layer name and the children of the level
+    # below were written by other processes, so the presence index can't be trusted
+    manager = WorldTextureManager()
+    manager.layer_name = layer_name
+    cache = RasterCache.instance()
+    built = []
+    for x in xs:
+        tile = WorldTileIndex(manager, zoom, x, y)
+        if cache.get_encoded(tile.cache_key, check_disk=True) is not None:
+            continue
+        encoded = synthesize_tile(tile, cache, check_disk=True)
+        if encoded is not None:
+            cache.put(tile.cache_key, encoded)
+            built.append(x)
+    return built
+
+
+def build_overviews(manager: WorldTextureManager, area: BaseGeometry, zooms: Tuple[int, int],
+                    processes: int = OVERVIEW_PROCESSES) -> int:
+    """Builds the tiles of the area from zooms[1] - 1 down to zooms[0] out of their cached children.
+
+    Levels go one at a time since each is built from the previous one, the rows of a level are built
+    on a process pool. Tiles already cached are kept. Returns the number of tiles built.
+    """
+    cache = RasterCache.instance()
+    built = 0
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_overview_worker,
+                             initargs=(raster_cache.CACHE_DIR,)) as executor:
+        for zoom in range(zooms[1] - 1, zooms[0] - 1, -1):
+            rows = {executor.submit(_build_overview_row, manager.layer_name, zoom, [tile.x for tile in tiles], y): y
+                    for y, tiles in iter_area_rows(manager, area, zoom)}
+            level_built = 0
+            for row, y in rows.items():
+                for x in row.result():
+                    cache.add_presence(WorldTileIndex(manager, zoom, x, y).cache_key)
+                    level_built += 1
+            print(f'zoom {zoom}: {level_built} tiles built')
+            built += level_built
+    return built
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Warms the tile cache for the area of a GeoJSON file')
+    parser.add_argument('geojson')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--zoom', type=int, nargs=2, metavar=('MIN', 'MAX'))
+    group.add_argument('--mpp', type=float, nargs=2, metavar=('FINEST', 'COARSEST'))
+    parser.add_argument('--workers', type=int, default=SEED_WORKERS)
+    parser.add_argument('--state', help='progress file, an interrupted run with the same file resumes')
+    parser.add_argument('--overviews', action='store_true',
+                        help='fetch only the max zoom and build the coarser ones from it, requires --zoom')
+    args = parser.parse_args()
+    if args.overviews and not args.zoom:
+        parser.error('--overviews requires --zoom')
+    manager, area = WorldTextureManager(), load_geojson(args.geojson)
+    if args.overviews:
+        seed_region(manager, area, zooms=(args.zoom[1], args.zoom[1]), state_path=args.state, workers=args.workers)
+        build_overviews(manager, area, args.zoom)
+    else:
+        seed_region(manager, area, zooms=args.zoom, mpp_range=args.mpp, state_path=args.state, workers=args.workers)
@@ -1,13 +1,12 @@
 ﻿import dataclasses
-from io import BytesIO
-from typing import List, Tuple
-from PIL import Image
+from concurrent.futures import Future, as_completed
+from typing import Dict, Iterable, Iterator, List, Tuple
 import numpy as np
-import requests
+import shapely
 from shapely.geometry import Polygon
 
-from .coord_convertor import lla_to_ecef, ecef_to_lla
-from .utils import bbox_middle, bbox_width, bbox_height
+from .tile_math import grid_to_lonlat, lonlat_to_grid, tile_mpp, tiles_mpp, tiles_world_bbox
+from .utils import quadkey_encode
 
 import math
 # def marcator_deg2num(lat_deg, lon_deg, zoom):
@@ -19,7 +18,11 @@ import math
 
 import math
 
+from world_render.world_textures.overviews import DerivedPolicy, synthesize_tile
+from world_render.world_textures.pack_store import PackStore
 from world_render.world_textures.raster_cache import RasterCache
+from world_render.world_textures.tile_fetcher import TileFetcher
+from world_render.world_textures.tile_sources import TileSource, UrlTileSource
 
 
 def marcator_num2deg(xtile, ytile, zoom):
@@ -42,39 +45,86 @@ class WorldTextureManager:
 		self.layer_name = 'QQQQ'
 		self.url = "https://tile.openstreetmap.org/{zoom}/{xtile}/{ytile}.png"
 		self.url = "https://gis.sinica.edu.tw/worldmap/file-exists.php?img=BingH-jpg-{zoom}-{xtile}-{ytile}.png"
+		self.tile_store: PackStore = None  # offline pack checked before the cache, its rasters are views into the pack
+		self.derived_policy = DerivedPolicy.PREFER  # when missing tiles are built from their cached children
 
-	def grid_to_wgs84lla(self, zoom, xtile, ytile):
-		#TODO fix
-		if self.is_mercator:
-			n = 2.0 ** zoom
-			lon_deg = xtile / n * 360.0 - 180.0
-			lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))
-			lat_deg = math.degrees(lat_rad)
-			return (lon_deg, lat_deg)
-		else:
-			devisions = 2 ** zoom
-			world_bbox = self.world_bbox
-			return (world_bbox[0] + (world_bbox[2] - world_bbox[0]) * xtile / devisions,
-					world_bbox[1] + (world_bbox[3] - world_bbox[1]) * ytile / devisions)
+	@property
+	def url(self):
+		return getattr(self.source, 'url', None)
 
-	def get_tile_url(self, tile: 'WorldTileIndex'):
-		return tile._manager.url.format(zoom=tile.zoom, xtile=tile.x, ytile=tile.y)
+	@url.setter
+	def url(self, url: str):
+		self.source: TileSource = UrlTileSource(url)
 
-	def load_tile(self, tile: 'WorldTileIndex'):
-		cache = RasterCache.instance()
-		with cache.lock(tile):
-			raster = cache.get(tile)
-			if raster is None:
-				res = requests.get(self.get_tile_url(tile))
-				if 200 <= res.status_code < 300:
-					raster = np.array(Image.open(BytesIO(res.content)))
-				else:
-					#TODO fix
-					pass
-				cache.put(tile, raster)
-		return raster
+	def grid_to_wgs84lla(self, zoom, xtile, ytile):
+		"""Scalar tile_math.grid_to_lonlat"""
+		lon, lat = grid_to_lonlat(self, zoom, xtile, ytile)
+		return (float(lon), float(lat))
 
+	def wgs84lla_to_grid(self, zoom, lon, lat):
+		"""Inverse of grid_to_wgs84lla, the grid position is fractional"""
+		x, y = lonlat_to_grid(self, zoom, lon, lat)
+		return (float(x), float(y))
 
+	def get_tile_url(self, tile: 'WorldTileIndex'):
+		return tile._manager.source.get_url(tile.zoom, tile.x, tile.y)
+
+	def load_tile(self, tile: 'WorldTileIndex', prefetched: Future = None):
+		"""prefetched is a pending source.fetch_many() result expected to hold this tile"""
+		if self.tile_store is not None:
+			raster = self.tile_store.get(tile.quadkey)
+			if raster is not None:
+				return raster
+		return RasterCache.instance().get_or_load(tile.cache_key, lambda: self._fetch_tile(tile, prefetched),
+												  lambda encoded: self._revalidate_tile(tile, encoded))
+
+	def load_encoded_tile(self, tile: 'WorldTileIndex'):
+		"""Makes sure the tile is in the cache without decoding it, returns its encoded form"""
+		return RasterCache.instance().load_encoded(tile.cache_key, lambda: self._fetch_tile(tile),
+												   lambda encoded: self._revalidate_tile(tile, encoded))
+
+	def _fetch_tile(self, tile: 'WorldTileIndex', prefetched: Future = None):
+		"""Loader of a cache miss, the source or the cached children depending on the derived policy"""
+		if self.derived_policy == DerivedPolicy.PREFER and tile.zoom < self.max_zoom:
+			encoded = synthesize_tile(tile)
+			if encoded is not None:
+				return encoded
+		encoded = None
+		if prefetched is not None:
+			encoded = prefetched.result().get((tile.zoom, tile.x, tile.y))
+		if encoded is None:
+			encoded = self.source.fetch(tile.zoom, tile.x, tile.y)
+		if encoded is None and self.derived_policy == DerivedPolicy.FALLBACK and tile.zoom < self.max_zoom:
+			encoded = synthesize_tile(tile)
+		return encoded
+
+	def _revalidate_tile(self, tile: 'WorldTileIndex', encoded):
+		"""Background check of a stale cached tile, derived tiles have no validators and are built again"""
+		if encoded.derived:
+			return self._fetch_tile(tile)
+		return self.source.revalidate(tile.zoom, tile.x, tile.y, encoded)
+
+	def load_tiles_async(self, tiles: Iterable['WorldTileIndex']) -> Dict['WorldTileIndex', Future]:
+		"""Starts loading the tiles on the fetcher pool, tiles already in flight share the same future.
+
+		Sources with bulk reads get the uncached tiles in a single fetch_many() call, it is submitted
+		before the tile loads so the pool always runs it ahead of the loads waiting for it.
+		"""
+		fetcher = TileFetcher.instance()
+		tiles = list(dict.fromkeys(tiles))
+		prefetched = None
+		if self.source.bulk_reads:
+			cache = RasterCache.instance()
+			missing = [(tile.zoom, tile.x, tile.y) for tile in tiles if tile.cache_key not in cache]
+			if missing:
+				prefetched = fetcher.submit(None, self.source.fetch_many, missing)
+		return {tile: fetcher.submit(tile, self.load_tile, tile, prefetched) for tile in tiles}
+
+	def load_tiles(self, tiles: Iterable['WorldTileIndex']) -> Iterator[Tuple['WorldTileIndex', np.ndarray]]:
+		"""Yields (tile, raster) pairs in completion order"""
+		futures = {future: tile for tile, future in self.load_tiles_async(tiles).items()}
+		for future in as_completed(futures):
+			yield futures[future], future.result()
 
 	@property
 	def query(self):
@@ -97,6 +147,16 @@ class WorldTileIndex:
 		x_range = (2 ** self.zoom)
 		return base + x_range * y + x
 
+	@property
+	def quadkey(self):
+		"""Morton code of x/y behind a zoom marker bit, unique over all zoom levels"""
+		return quadkey_encode(self.zoom, self.x, self.y)
+
+	@property
+	def cache_key(self):
+		"""Compact key of the tile raster, only depends on the layer name and not on the rest of the manager"""
+		return (self._manager.layer_name, self.quadkey)
+
 	@property
 	def world_bbox(self):
 		"""Returns the bounding box of the tile in WGS-84 lla"""
@@ -121,14 +181,7 @@ class WorldTileIndex:
 	@property
 	def mpp(self):
 		"""Returns the meter per pixel resolution"""
-		bbox = self.world_bbox
-		middle = bbox_middle(bbox)
-		pixel_width = bbox_width(bbox) / self._manager.tile_size
-		pixel_height = bbox_height(bbox) / self._manager.tile_size
-		center = np.array(lla_to_ecef(middle[0], middle[1]))
-		center_dx = np.array(lla_to_ecef(middle[0] + pixel_width, middle[1]))
-		center_dy = np.array(lla_to_ecef(middle[0], middle[1] + pixel_height))
-		return max(np.linalg.norm(center - center_dx), np.linalg.norm(center - center_dy))
+		return tile_mpp(self._manager, self.zoom, self.y)
 
 	def __repr__(self):
 		return f'<Tile: {self._manager.get_tile_url(self)}>'
@@ -139,42 +192,50 @@ class WorldTextureQuerier:
 		self._manager = manager
 
 	def get_tile_list_for_area(self, roi: Polygon, meter_per_pixels: List[int]):
+		"""Mixed zoom tiles covering the roi, refined breadth first one zoom level batch at a time"""
 		if isinstance(meter_per_pixels, (int, float)):
 			meter_per_pixels = [meter_per_pixels] * (len(roi.exterior.coords) - 1)
-
-		return self._get_tile_list_for_area_rec(WorldTileIndex(self._manager, 0, 0, 0), roi, meter_per_pixels)
-
-	def _get_tile_list_for_area_rec(self, tile: WorldTileIndex, roi: Polygon, meter_per_pixels: List[int]):
-		# TODO improve this function, any part of a tile is not detailed enough all the tile is replaced instead of just that part
-		tile_bounds = Polygon.from_bounds(*tile.world_bbox)
-		if not tile_bounds.intersects(roi):
-			return []
-		if self._is_tile_detailed_enough(tile, roi, meter_per_pixels):
-			return [tile]
-		else:
-			ret = []
-			for child in tile.get_children():
-				 self._get_tile_list_for_area_rec(child, roi, meter_per_pixels)
-			return ret
+		shapely.prepare(roi)
+
+		tiles = []
+		zoom, xs, ys = 0, np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64)
+		while len(xs):
+			boxes = shapely.box(*tiles_world_bbox(self._manager, zoom, xs, ys).T)
+			touching = shapely.intersects(boxes, roi)
+			xs, ys, boxes = xs[touching], ys[touching], boxes[touching]
+			detailed = self._are_tiles_detailed_enough(zoom, xs, ys, boxes, roi, meter_per_pixels)
+			tiles.extend(WorldTileIndex(self._manager, zoom, x, y) for x, y in zip(xs[detailed].tolist(), ys[detailed].tolist()))
+			# children in get_children() order, bl, br, tl, tr
+			xs = (xs[~detailed, None] * 2 + [0, 1, 0, 1]).ravel()
+			ys = (ys[~detailed, None] * 2 + [0, 0, 1, 1]).ravel()
+			zoom += 1
+		return tiles
+
+	def _are_tiles_detailed_enough(self, zoom: int, xs: np.ndarray, ys: np.ndarray, boxes: np.ndarray,
+								   roi: Polygon, meter_per_pixels: List[int]) -> np.ndarray:
+		if zoom < self._manager.min_zoom:
+			return np.zeros(len(xs), dtype=bool)
+		if zoom >= self._manager.max_zoom:
+			return np.ones(len(xs), dtype=bool)
+
+		tiles_in_roi = shapely.intersection(boxes, roi)
+		coords, tile_indices = shapely.get_coordinates(tiles_in_roi, return_index=True)
+		required_mpp = np.full(len(xs), np.inf)
+		np.minimum.at(required_mpp, tile_indices, self._interpolate_polygon_values(roi, meter_per_pixels, coords))
+		return required_mpp >= tiles_mpp(self._manager, zoom, xs, ys)
 
 	def _is_tile_detailed_enough(self, tile: WorldTileIndex, roi: Polygon, meter_per_pixels: List[int]):
-		if tile.zoom < self._manager.min_zoom:
-			return False
-		if tile.zoom >= self._manager.max_zoom:
-			return True
-
-		tile_bounds = Polygon.from_bounds(*tile.world_bbox)
-		tile_in_roi = tile_bounds.intersection(roi)
-		for x,y in tile_in_roi.exterior.coords:
-			required_mpp = self._interpolate_polygon_value(roi, meter_per_pixels, (x,y))
-			if required_mpp < tile.mpp:
-				return False
-		return True
+		boxes = np.array([Polygon.from_bounds(*tile.world_bbox)])
+		return bool(self._are_tiles_detailed_enough(tile.zoom, np.array([tile.x]), np.array([tile.y]),
+													boxes, roi, meter_per_pixels)[0])
+
+	def _interpolate_polygon_values(self, polygon: Polygon, vertex_values: List[float], positions: np.ndarray):
+		vertices = np.asarray(polygon.exterior.coords[:-1])
+		distances = np.linalg.norm(positions[:, None, :] - vertices[None, :, :], axis=-1)
+		return distances @ np.asarray(vertex_values, dtype=np.float64) / distances.sum(axis=1)
 
 	def _interpolate_polygon_value(self, polygon: Polygon, vertex_values: List[float], pos: Tuple[float, float]):
-		distances = [np.linalg.norm([pos[0] - vert[0], pos[1] - vert[1]]) for vert in polygon.exterior.coords[:-1]]
-		sum_dist = sum(distances)
-		return sum(distances[index] * value for index, value in enumerate(vertex_values)) / sum_dist
+		return float(self._interpolate_polygon_values(polygon, vertex_values, np.array([pos], dtype=np.float64))[0])
 
 	@property
 	def world_bbox(self):
@@ -185,7 +246,37 @@ class WorldTextureQuerier:
 		return self._tile_size
 
 def _print_tile(tile):
-	print(tile._manager.url.format(zoom=tile.zoom, xtile=tile.x, ytile=tile.y))
+	print(tile._manager.get_tile_url(tile))
+
+
+def _benchmark_tile_query():
+	"""Breadth first batched query against refining one tile at a time, on a city and a country sized roi"""
+	import time
+	from collections import Counter
+
+	def query_tile_by_tile(querier, tile, roi, meter_per_pixels):
+		if not Polygon.from_bounds(*tile.world_bbox).intersects(roi):
+			return []
+		if querier._is_tile_detailed_enough(tile, roi, meter_per_pixels):
+			return [tile]
+		return [found for child in tile.get_children()
+				for found in query_tile_by_tile(querier, child, roi, meter_per_pixels)]
+
+	manager = WorldTextureManager()
+	rois = {'city': (Polygon([[34.809299, 32.105306], [34.816682, 32.027579], [34.741740, 32.031382]]), [1, 4, 8]),
+			'country': (Polygon([[34.27, 31.22], [35.57, 33.28], [35.9, 32.7], [35.45, 31.5], [34.95, 29.5]]),
+						[10, 40, 80, 80, 160])}
+	for name, (roi, mpp) in rois.items():
+		start = time.perf_counter()
+		tiles = manager.query.get_tile_list_for_area(roi, mpp)
+		batched = time.perf_counter() - start
+		start = time.perf_counter()
+		reference = query_tile_by_tile(manager.query, WorldTileIndex(manager, 0, 0, 0), roi, mpp)
+		tile_by_tile = time.perf_counter() - start
+		assert set(tiles) == set(reference)
+		print(f'{name}: {len(tiles)} tiles {dict(sorted(Counter(tile.zoom for tile in tiles).items()))}, '
+			  f'batched {batched * 1000:.0f}ms, tile by tile {tile_by_tile * 1000:.0f}ms')
+
 
 if __name__ == '__main__':
 	tel_aviv_poly = Polygon([[-179, -88],
@@ -0,0 +1,104 @@
+import dataclasses
+import os
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+DECODE_WORKERS = os.cpu_count() or 4
+
+
+@dataclasses.dataclass
+class EncodedTile:
+    """Tile as served by its source, this is what the disk cache stores"""
+    data: bytes
+    content_type: str = ''
+    derived: bool = False  # built from other cached tiles rather than fetched, see overviews.py
+    etag: str = ''  # http validators of the source response, see TileSource.revalidate()
+    last_modified: str = ''
+    validated_at: float = 0  # when the source last confirmed the data, set by RasterCache.put()
+
+    @property
+    def nbytes(self):
+        return len(self.data)
+
+
+def decode_tile(encoded: EncodedTile) -> np.ndarray:
+    image = Image.open(BytesIO(encoded.data))
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    return np.asarray(image)
+
+
+def encode_tile(raster: np.ndarray, format: str = 'PNG') -> EncodedTile:
+    out = BytesIO()
+    image = Image.fromarray(raster)
+    if format == 'JPEG' and image.mode == 'RGBA':
+        image = image.convert('RGB')
+    image.save(out, format=format)
+    return EncodedTile(out.getvalue(), Image.MIME[format])
+
+
+class TileDecoder:
+    """Decodes tiles on a worker pool, PIL releases the GIL while decoding so threads are the default"""
+    _instance: 'TileDecoder' = None
+
+    @classmethod
+    def instance(cls):
+        if not cls._instance:
+            cls._instance = TileDecoder()
+        return cls._instance
+
+    def __init__(self, executor: Executor = None):
+        self._executor = executor or ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix='tile-decoder')
+
+    def submit(self, encoded: EncodedTile) -> Future:
+        return self._executor.submit(decode_tile, encoded)
+
+    def decode(self, encoded: EncodedTile) -> np.ndarray:
+        return self.submit(encoded).result()
+
+
+def _synthetic_tile(seed: int, size: int = 256):
+    """Smooth noise with some detail, compresses roughly like an aerial photo tile"""
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(0, 256, (size // 16, size // 16, 3)).astype(np.float32)
+    smooth = np.kron(coarse, np.ones((16, 16, 1), dtype=np.float32))
+    detail = rng.normal(0, 6, (size, size, 3))
+    return np.clip(smooth + detail, 0, 255).astype(np.uint8)
+
+
+def _benchmark_encoded_storage(num_tiles: int = 200):
+    """Compares cache capacity and decode throughput of pickled rasters against encoded tiles"""
+    import pickle
+    import time
+    from world_render.world_textures.raster_cache import CACHE_SIZE
+
+    rasters = [_synthetic_tile(seed) for seed in range(num_tiles)]
+    pickled_size = np.mean([len(pickle.dumps(raster)) for raster in rasters])
+    for format in ('PNG', 'JPEG'):
+        tiles = [encode_tile(raster, format) for raster in rasters]
+        encoded_size = np.mean([tile.nbytes for tile in tiles])
+        print(f'{format}: {pickled_size / 1024:.0f}KB pickled vs {encoded_size / 1024:.0f}KB encoded, '
+              f'{CACHE_SIZE / pickled_size:.0f} vs {CACHE_SIZE / encoded_size:.0f} tiles per cache')
+
+        start = time.perf_counter()
+        for tile in tiles:
+            decode_tile(tile)
+        serial = num_tiles / (time.perf_counter() - start)
+        decoder = TileDecoder()
+        start = time.perf_counter()
+        for future in [decoder.submit(tile) for tile in tiles]:
+            future.result()
+        pooled = num_tiles / (time.perf_counter() - start)
+        start = time.perf_counter()
+        for raster in [pickle.dumps(raster) for raster in rasters]:
+            pickle.loads(raster)
+        unpickle = num_tiles / (time.perf_counter() - start)
+        print(f'{format}: decode {serial:.0f} tiles/s serial, {pooled:.0f} tiles/s on {DECODE_WORKERS} workers, '
+              f'unpickle {unpickle:.0f} tiles/s')
+
+
+if __name__ == '__main__':
+    _benchmark_encoded_storage()
@@ -0,0 +1,85 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+POOL_WORKERS = 16
+MAX_REQUESTS_PER_HOST = 6
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5  # seconds, doubled on every retry
+REQUEST_TIMEOUT = 30  # seconds
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class TileFetcher:
+    """Thread pool over a pooled http session, merges duplicate requests that are already in flight"""
+    _instance: 'TileFetcher' = None
+
+    @classmethod
+    def instance(cls):
+        if not cls._instance:
+            cls._instance = TileFetcher()
+        return cls._instance
+
+    def __init__(self, workers: int = POOL_WORKERS, max_requests_per_host: int = MAX_REQUESTS_PER_HOST,
+                 retries: int = MAX_RETRIES, backoff: float = BACKOFF_FACTOR, timeout: float = REQUEST_TIMEOUT):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tile-fetcher')
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._max_requests_per_host = max_requests_per_host
+        self._retries = retries
+        self._backoff = backoff
+        self._timeout = timeout
+        self._host_limits: Dict[str, threading.BoundedSemaphore] = {}
+        self._in_flight: Dict[Hashable, Future] = {}
+        self._lock = threading.RLock()
+
+    def submit(self, key: Optional[Hashable], fn: Callable, *args) -> Future:
+        """Runs fn on the pool, a key that is already in flight gets the running future instead (None never merges)"""
+        if key is None:
+            return self._executor.submit(fn, *args)
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is None:
+                future = self._executor.submit(fn, *args)
+                self._in_flight[key] = future
+                future.add_done_callback(lambda f, key=key: self._forget(key, f))
+        return future
+
+    def _forget(self, key: Hashable, future: Future):
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def _host_limit(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self._max_requests_per_host)
+            return self._host_limits[host]
+
+    def get(self, url: str, **kwargs) -> Optional[requests.Response]:
+        """Blocking GET on the pooled session with retry and exponential backoff, None if the host was never reached"""
+        kwargs.setdefault('timeout', self._timeout)
+        res = None
+        for attempt in range(self._retries + 1):
+            if attempt:
+                time.sleep(self._backoff * 2 ** (attempt - 1))
+            try:
+                with self._host_limit(url):
+                    res = self._session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                continue
+            if res.status_code not in RETRY_STATUS_CODES:
+                break
+        return res
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+        self._session.close()
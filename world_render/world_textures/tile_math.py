@@ -0,0 +1,88 @@
+# Tile math over arrays of tiles, zoom/x/y are anything numpy broadcasts together.
+# The manager argument only provides the grid configuration (is_mercator, world_bbox, tile_size).
+from typing import Tuple
+
+import numpy as np
+
+from .coord_convertor import lla_to_ecef
+
+MERCATOR_MAX_LAT = 85.0511287798
+MPP_MEMO_SIZE = 2 ** 20
+
+_mpp_memo = {}
+
+
+def _grid_key(manager):
+    return manager.is_mercator, tuple(manager.world_bbox), manager.tile_size
+
+
+def grid_to_lonlat(manager, zoom, x, y) -> Tuple[np.ndarray, np.ndarray]:
+    # plain numpy ufuncs so python scalars stay cheap for the scalar wrappers
+    n = np.exp2(zoom)
+    if manager.is_mercator:
+        lon = x / n * 360.0 - 180.0
+        lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / n))))
+    else:
+        world_bbox = manager.world_bbox
+        lon = world_bbox[0] + (world_bbox[2] - world_bbox[0]) * x / n
+        lat = world_bbox[1] + (world_bbox[3] - world_bbox[1]) * y / n
+    return lon, lat
+
+
+def lonlat_to_grid(manager, zoom, lon, lat) -> Tuple[np.ndarray, np.ndarray]:
+    """Inverse of grid_to_lonlat, the grid positions are fractional"""
+    n = np.exp2(zoom)
+    if manager.is_mercator:
+        lat_rad = np.radians(np.clip(lat, -MERCATOR_MAX_LAT, MERCATOR_MAX_LAT))
+        return (lon + 180.0) / 360.0 * n, (1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * n
+    world_bbox = manager.world_bbox
+    return ((lon - world_bbox[0]) / (world_bbox[2] - world_bbox[0]) * n,
+            (lat - world_bbox[1]) / (world_bbox[3] - world_bbox[1]) * n)
+
+
+def tiles_world_bbox(manager, zoom, x, y) -> np.ndarray:
+    """(N, 4) WGS-84 bounding boxes as min lon, min lat, max lon, max lat"""
+    zoom, x, y = np.broadcast_arrays(np.asarray(zoom), np.asarray(x), np.asarray(y))
+    bl_lon, bl_lat = grid_to_lonlat(manager, zoom, x, y)
+    tr_lon, tr_lat = grid_to_lonlat(manager, zoom, x + 1, y + 1)
+    return np.stack([bl_lon, np.minimum(bl_lat, tr_lat), tr_lon, np.maximum(bl_lat, tr_lat)], axis=-1).reshape(-1, 4)
+
+
+def _rows_mpp(manager, zoom: np.ndarray, y: np.ndarray) -> np.ndarray:
+    # the resolution doesn't depend on the longitude, so any column gives the one of the row
+    bbox = tiles_world_bbox(manager, zoom, 0, y)
+    middle_lon = (bbox[:, 0] + bbox[:, 2]) / 2
+    middle_lat = (bbox[:, 1] + bbox[:, 3]) / 2
+    pixel_width = (bbox[:, 2] - bbox[:, 0]) / manager.tile_size
+    pixel_height = (bbox[:, 3] - bbox[:, 1]) / manager.tile_size
+    lon = np.concatenate([middle_lon, middle_lon + pixel_width, middle_lon])
+    lat = np.concatenate([middle_lat, middle_lat, middle_lat + pixel_height])
+    center, center_dx, center_dy = np.split(np.stack(lla_to_ecef(lon, lat, np.zeros_like(lon)), axis=-1), 3)
+    return np.maximum(np.linalg.norm(center - center_dx, axis=-1), np.linalg.norm(center - center_dy, axis=-1))
+
+
+def tiles_mpp(manager, zoom, x, y) -> np.ndarray:
+    """Meter per pixel resolution of the tiles, memoized per grid row since it only depends on zoom and y"""
+    zoom, _, y = (a.ravel() for a in np.broadcast_arrays(
+        np.asarray(zoom, dtype=np.int64), np.asarray(x, dtype=np.int64), np.asarray(y, dtype=np.int64)))
+    rows, inverse = np.unique(np.stack([zoom, y], axis=-1), axis=0, return_inverse=True)
+    grid_key = _grid_key(manager)
+    keys = [(grid_key, row_zoom, row_y) for row_zoom, row_y in rows.tolist()]
+    values = np.array([_mpp_memo.get(key, np.nan) for key in keys], dtype=np.float64)
+    missing = np.isnan(values)
+    if missing.any():
+        values[missing] = _rows_mpp(manager, rows[missing, 0], rows[missing, 1])
+        if len(_mpp_memo) > MPP_MEMO_SIZE:
+            _mpp_memo.clear()
+        _mpp_memo.update((key, value) for key, value, new in zip(keys, values.tolist(), missing) if new)
+    return values[inverse.ravel()]
+
+
+def tile_mpp(manager, zoom: int, y: int) -> float:
+    """Scalar tiles_mpp(), a memo hit skips numpy altogether"""
+    key = (_grid_key(manager), zoom, y)
+    value = _mpp_memo.get(key)
+    if value is None:
+        value = float(_rows_mpp(manager, np.array([zoom]), np.array([y]))[0])
+        _mpp_memo[key] = value
+    return value
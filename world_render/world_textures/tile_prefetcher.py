@@ -0,0 +1,226 @@
+import collections
+import math
+import threading
+import time
+from concurrent.futures import Future
+from typing import Deque, Dict, Iterable, List, Set, Tuple
+
+import numpy as np
+from shapely.geometry import Polygon
+
+from world_render.world_textures.raster_cache import RasterCache
+from world_render.world_textures.texture_manager import WorldTextureManager, WorldTextureQuerier, WorldTileIndex
+from world_render.world_textures.tile_fetcher import TileFetcher
+
+VIEW_HISTORY = 8  # recent views the motion is fitted on
+PREFETCH_LOOKAHEAD = 1.0  # seconds of extrapolated motion that get prefetched
+LOOKAHEAD_STEPS = 4  # predicted views within the lookahead
+PREFETCH_IN_FLIGHT = 4  # prefetch loads on the fetcher pool at once, bounds how long a visible load waits behind them
+MAX_PREFETCH_QUEUE = 4096  # queued prefetches, the oldest predictions are dropped first
+PREFETCH_EXPIRY = 4.0  # seconds a prefetched tile has to become visible before it counts as wasted, a few lookaheads
+MAX_PREFETCHED = 4096  # prefetched tiles waiting to be shown, the oldest count as wasted beyond it
+
+View = Tuple[float, Tuple[float, float, float, float], float]  # time, lon/lat bbox, meter per pixel
+
+
+class TilePrefetcher:
+    """Loads the tiles of the views the camera is about to show, ahead of them being visible.
+
+    observe() records every view, the motion of the last VIEW_HISTORY views is fitted linearly and
+    extrapolated PREFETCH_LOOKAHEAD seconds ahead. The tiles of the predicted views, a ring of their
+    neighbours and the next zoom level in the direction of the zoom, if any, are queued for prefetching.
+    Prefetches only go out while no visible load is pending and at most PREFETCH_IN_FLIGHT at once,
+    so loads through request_visible() never wait behind more than a few of them. Tiles already
+    cached are never prefetched, stats() reports how many visible tiles a prefetch brought in and how
+    many prefetched tiles were not shown within PREFETCH_EXPIRY seconds.
+    """
+
+    def __init__(self, manager: WorldTextureManager, lookahead: float = PREFETCH_LOOKAHEAD,
+                 steps: int = LOOKAHEAD_STEPS, in_flight: int = PREFETCH_IN_FLIGHT, expiry: float = PREFETCH_EXPIRY):
+        self._manager = manager
+        self._querier = WorldTextureQuerier(manager)
+        self.lookahead = lookahead
+        self.steps = steps
+        self.in_flight = in_flight
+        self.expiry = expiry
+        self._views: Deque[View] = collections.deque(maxlen=VIEW_HISTORY)
+        self._queue: 'collections.OrderedDict[WorldTileIndex, None]' = collections.OrderedDict()
+        self._prefetching: Set[WorldTileIndex] = set()
+        # loaded by a prefetch and not shown yet, oldest first with the time they arrived
+        self._prefetched: 'collections.OrderedDict[WorldTileIndex, float]' = collections.OrderedDict()
+        self._visible_pending = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0  # visible tiles loaded from the source with no prefetch
+        self.late_hits = 0  # the prefetch was still loading when the tile became visible
+        self.prefetches = 0
+        self.wasted = 0  # prefetched tiles that expired without being shown
+
+    def observe(self, bbox: Tuple[float, float, float, float], meter_per_pixel: float, timestamp: float = None):
+        """Records the current view and queues the tiles of the predicted ones"""
+        self._views.append((time.monotonic() if timestamp is None else timestamp, tuple(bbox), meter_per_pixel))
+        tiles = self._predicted_tiles()
+        with self._lock:
+            for tile in tiles:
+                self._queue[tile] = None
+                self._queue.move_to_end(tile)
+            while len(self._queue) > MAX_PREFETCH_QUEUE:
+                self._queue.popitem(last=False)
+            self._expire_prefetched()
+        self._pump()
+
+    def predict(self) -> List[Tuple[Tuple[float, float, float, float], float]]:
+        """(bbox, meter per pixel) of the views expected over the lookahead, empty until the camera moved"""
+        if len(self._views) < 2:
+            return []
+        times = np.array([view[0] for view in self._views])
+        if times[-1] - times[0] <= 0:
+            return []
+        # center and log scale move linearly, a zoom keeps changing the scale by the same factor per second
+        bboxes = np.array([view[1] for view in self._views])
+        tracks = np.column_stack([(bboxes[:, 0] + bboxes[:, 2]) / 2, (bboxes[:, 1] + bboxes[:, 3]) / 2,
+                                  np.log(bboxes[:, 2] - bboxes[:, 0]), np.log(bboxes[:, 3] - bboxes[:, 1]),
+                                  np.log([view[2] for view in self._views])])
+        elapsed = times - times[-1]
+        velocity = np.polyfit(elapsed, tracks, 1)[0]
+        if not np.any(velocity):
+            return []
+        views = []
+        for step in range(1, self.steps + 1):
+            lon, lat, log_width, log_height, log_mpp = tracks[-1] + velocity * self.lookahead * step / self.steps
+            width, height = math.exp(log_width), math.exp(log_height)
+            bbox = (lon - width / 2, max(-85.0, lat - height / 2), lon + width / 2, min(85.0, lat + height / 2))
+            views.append((bbox, math.exp(log_mpp)))
+        return views
+
+    def _predicted_tiles(self) -> List[WorldTileIndex]:
+        views = self.predict()
+        if not views:
+            return []
+        zoom_rate = views[-1][1] / self._views[-1][2]
+        tiles = []
+        for bbox, meter_per_pixel in views:
+            for tile in self._querier.get_tile_list_for_area(Polygon.from_bounds(*bbox), meter_per_pixel):
+                tiles.append(tile)
+                tiles.extend(self._ring(tile))
+                if zoom_rate < 1 and tile.zoom < self._manager.max_zoom:
+                    tiles.extend(tile.get_children())
+                elif zoom_rate > 1 and tile.zoom > self._manager.min_zoom:
+                    tiles.append(tile.parent)
+        cache = RasterCache.instance()
+        return [tile for tile in dict.fromkeys(tiles) if tile.cache_key not in cache]
+
+    def _ring(self, tile: WorldTileIndex) -> List[WorldTileIndex]:
+        size = 2 ** tile.zoom
+        return [WorldTileIndex(self._manager, tile.zoom, (tile.x + dx) % size, tile.y + dy)
+                for dy in (-1, 0, 1) for dx in (-1, 0, 1) if (dx or dy) and 0 <= tile.y + dy < size]
+
+    def request_visible(self, tiles: Iterable[WorldTileIndex]) -> Dict[WorldTileIndex, Future]:
+        """Loads the visible tiles ahead of any queued prefetch, same result as load_tiles_async()"""
+        tiles = list(dict.fromkeys(tiles))
+        cache = RasterCache.instance()
+        with self._lock:
+            for tile in tiles:
+                self._queue.pop(tile, None)
+                if self._prefetched.pop(tile, None) is not None:
+                    self.hits += 1
+                elif tile in self._prefetching:
+                    self.late_hits += 1
+                elif tile.cache_key not in cache:
+                    self.misses += 1
+            self._visible_pending += len(tiles)
+        futures = self._manager.load_tiles_async(tiles)
+        for future in futures.values():
+            future.add_done_callback(self._visible_done)
+        return futures
+
+    def _visible_done(self, future: Future):
+        with self._lock:
+            self._visible_pending -= 1
+        self._pump()
+
+    def _pump(self):
+        """Sends queued prefetches to the fetcher pool while no visible load is pending"""
+        fetcher = TileFetcher.instance()
+        while True:
+            with self._lock:
+                if self._visible_pending or len(self._prefetching) >= self.in_flight or not self._queue:
+                    return
+                tile, _ = self._queue.popitem(last=False)
+                self._prefetching.add(tile)
+                self.prefetches += 1
+            future = fetcher.submit(tile, self._manager.load_tile, tile)
+            future.add_done_callback(lambda future, tile=tile: self._prefetch_done(tile, future))
+
+    def _prefetch_done(self, tile: WorldTileIndex, future: Future):
+        with self._lock:
+            self._prefetching.discard(tile)
+            if future.exception() is None:
+                self._prefetched[tile] = time.monotonic()
+            self._expire_prefetched()
+        self._pump()
+
+    def _expire_prefetched(self):
+        # called under the lock
+        deadline = time.monotonic() - self.expiry
+        while self._prefetched:
+            tile, arrived = next(iter(self._prefetched.items()))
+            if len(self._prefetched) <= MAX_PREFETCHED and arrived >= deadline:
+                break
+            del self._prefetched[tile]
+            self.wasted += 1
+
+    @property
+    def pending(self) -> int:
+        return len(self._queue) + len(self._prefetching)
+
+    def stats(self) -> Dict[str, float]:
+        """hit_rate is the share of the uncached visible tiles a prefetch already loaded, late hits count as misses,
+        wasted are the prefetched tiles that expired unshown and unshown those still waiting to be shown
+        """
+        with self._lock:
+            self._expire_prefetched()
+            loads = self.hits + self.late_hits + self.misses
+            return {'hits': self.hits, 'late_hits': self.late_hits, 'misses': self.misses,
+                    'hit_rate': self.hits / loads if loads else 0.0, 'prefetches': self.prefetches,
+                    'wasted': self.wasted, 'unshown': len(self._prefetched), 'queued': len(self._queue)}
+
+
+def _example_prefetcher(frames: int = 60, frame_time: float = 0.1, latency: float = 0.05):
+    """A steady pan over a source with a fixed latency, the visible tiles a prefetch brought in"""
+    import tempfile
+    import world_render.world_textures.raster_cache as raster_cache
+    from world_render.world_textures.tile_codec import encode_tile
+    from world_render.world_textures.tile_sources import TileSource
+
+    class _SlowSource(TileSource):
+        def __init__(self):
+            self.encoded = encode_tile(np.zeros((256, 256, 3), dtype=np.uint8), 'PNG')
+            self.fetches = 0
+
+        def get_url(self, zoom: int, x: int, y: int) -> str:
+            return f'slow://{zoom}/{x}/{y}'
+
+        def fetch(self, zoom: int, x: int, y: int):
+            time.sleep(latency)
+            self.fetches += 1
+            return self.encoded
+
+    raster_cache.CACHE_DIR = tempfile.mkdtemp()
+    manager = WorldTextureManager()
+    manager.source = _SlowSource()
+    prefetcher = TilePrefetcher(manager)
+    start = time.monotonic()
+    for frame in range(frames):
+        lon = 34.0 + frame * 0.01
+        bbox, meter_per_pixel = (lon, 32.0, lon + 0.1, 32.06), 40.0
+        visible = prefetcher._querier.get_tile_list_for_area(Polygon.from_bounds(*bbox), meter_per_pixel)
+        for future in prefetcher.request_visible(visible).values():
+            future.result()
+        prefetcher.observe(bbox, meter_per_pixel)
+        time.sleep(max(0.0, start + (frame + 1) * frame_time - time.monotonic()))
+    print(prefetcher.stats(), f'{manager.source.fetches} fetches from the source')
+
+
+if __name__ == '__main__':
+    _example_prefetcher()
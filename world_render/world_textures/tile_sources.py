@@ -0,0 +1,201 @@
+import sqlite3
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+from world_render.world_textures.tile_codec import EncodedTile
+from world_render.world_textures.tile_fetcher import TileFetcher
+
+TileCoords = Tuple[int, int, int]  # zoom, x, y
+SPARSE_REGION_FACTOR = 4  # a bulk read reads the bounding range only if it is at most this many times the tiles asked
+
+MBTILES_CONTENT_TYPES = {'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+
+
+class TileSource:
+    """Where the encoded tiles of a layer come from"""
+    bulk_reads = False  # True if fetch_many() is cheaper than fetching the tiles one by one
+
+    def get_url(self, zoom: int, x: int, y: int) -> str:
+        raise NotImplementedError()
+
+    def fetch(self, zoom: int, x: int, y: int) -> Optional[EncodedTile]:
+        raise NotImplementedError()
+
+    def revalidate(self, zoom: int, x: int, y: int, encoded: EncodedTile) -> Optional[EncodedTile]:
+        """Checks a cached tile against the source, returns encoded itself if it didn't change, the new tile
+        if it did and None if the source couldn't tell. Sources without validators fetch the tile again.
+        """
+        return self.fetch(zoom, x, y)
+
+    def fetch_many(self, tiles: Iterable[TileCoords]) -> Dict[TileCoords, EncodedTile]:
+        """Tiles missing from the source are left out of the result"""
+        result = {}
+        for zoom, x, y in tiles:
+            encoded = self.fetch(zoom, x, y)
+            if encoded is not None:
+                result[(zoom, x, y)] = encoded
+        return result
+
+
+class UrlTileSource(TileSource):
+    """Tiles served over http by a {zoom}/{xtile}/{ytile} url template"""
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def get_url(self, zoom: int, x: int, y: int) -> str:
+        return self.url.format(zoom=zoom, xtile=x, ytile=y)
+
+    def fetch(self, zoom: int, x: int, y: int) -> Optional[EncodedTile]:
+        return self._encoded(TileFetcher.instance().get(self.get_url(zoom, x, y)))
+
+    def revalidate(self, zoom: int, x: int, y: int, encoded: EncodedTile) -> Optional[EncodedTile]:
+        """Conditional GET with the validators of the cached response, a 304 transfers no tile data"""
+        headers = {}
+        if encoded.etag:
+            headers['If-None-Match'] = encoded.etag
+        if encoded.last_modified:
+            headers['If-Modified-Since'] = encoded.last_modified
+        res = TileFetcher.instance().get(self.get_url(zoom, x, y), headers=headers)
+        if res is not None and res.status_code == 304:
+            return encoded
+        return self._encoded(res)
+
+    @staticmethod
+    def _encoded(res) -> Optional[EncodedTile]:
+        if res is not None and 200 <= res.status_code < 300:
+            return EncodedTile(res.content, res.headers.get('Content-Type', ''), etag=res.headers.get('ETag', ''),
+                               last_modified=res.headers.get('Last-Modified', ''))
+        #TODO fix, report failed fetches
+        return None
+
+
+class MBTilesSource(TileSource):
+    """Tiles of an MBTiles (SQLite) file, rows are stored flipped (TMS) so y is converted on every read"""
+    bulk_reads = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        metadata = dict(self._connection().execute('SELECT name, value FROM metadata'))
+        self.content_type = MBTILES_CONTENT_TYPES.get(metadata.get('format', 'png'), '')
+        self.min_zoom = int(metadata['minzoom']) if 'minzoom' in metadata else None
+        self.max_zoom = int(metadata['maxzoom']) if 'maxzoom' in metadata else None
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads, every thread gets its own read only one
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _flip(zoom: int, y: int) -> int:
+        return (1 << zoom) - 1 - y
+
+    def get_url(self, zoom: int, x: int, y: int) -> str:
+        return f'mbtiles:{self.path}#{zoom}/{x}/{y}'
+
+    def fetch(self, zoom: int, x: int, y: int) -> Optional[EncodedTile]:
+        row = self._connection().execute(
+            'SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+            (zoom, x, self._flip(zoom, y))).fetchone()
+        return None if row is None else EncodedTile(bytes(row[0]), self.content_type)
+
+    def fetch_region(self, zoom: int, x_range: Tuple[int, int], y_range: Tuple[int, int]) \
+            -> Iterator[Tuple[TileCoords, EncodedTile]]:
+        """All tiles of a zoom level in the inclusive x/y ranges, read in a single query"""
+        rows = self._connection().execute(
+            'SELECT tile_column, tile_row, tile_data FROM tiles '
+            'WHERE zoom_level=? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?',
+            (zoom, x_range[0], x_range[1], self._flip(zoom, y_range[1]), self._flip(zoom, y_range[0])))
+        for x, row, data in rows:
+            yield (zoom, x, self._flip(zoom, row)), EncodedTile(bytes(data), self.content_type)
+
+    def fetch_many(self, tiles: Iterable[TileCoords]) -> Dict[TileCoords, EncodedTile]:
+        by_zoom = defaultdict(set)
+        for zoom, x, y in tiles:
+            by_zoom[zoom].add((x, y))
+        result = {}
+        for zoom, coords in by_zoom.items():
+            xs, ys = [x for x, _ in coords], [y for _, y in coords]
+            x_range, y_range = (min(xs), max(xs)), (min(ys), max(ys))
+            area = (x_range[1] - x_range[0] + 1) * (y_range[1] - y_range[0] + 1)
+            if area <= SPARSE_REGION_FACTOR * len(coords):
+                result.update((key, encoded) for key, encoded in self.fetch_region(zoom, x_range, y_range)
+                              if key[1:] in coords)
+            else:
+                result.update(super().fetch_many((zoom, x, y) for x, y in coords))
+        return result
+
+
+def _example_revalidation(tiles: int = 64, latency: float = 0.05):
+    """Bytes and latency of loading expired tiles, refetched in full against revalidated with conditional GETs,
+    served by a local stub that answers If-None-Match with 304
+    """
+    import hashlib
+    import tempfile
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import numpy as np
+    import world_render.world_textures.raster_cache as raster_cache
+    from world_render.world_textures.overviews import DerivedPolicy
+    from world_render.world_textures.texture_manager import WorldTextureManager, WorldTileIndex
+    from world_render.world_textures.tile_codec import encode_tile
+
+    body = encode_tile(np.random.default_rng(0).integers(0, 255, (256, 256, 3), dtype=np.uint8)).data
+    etag = '"' + hashlib.md5(body).hexdigest() + '"'
+    sent = {'requests': 0, 'bytes': 0}
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            sent['requests'] += 1
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', 'Mon, 01 Jan 2024 00:00:00 GMT')
+            self.end_headers()
+            self.wfile.write(body)
+            sent['bytes'] += len(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    raster_cache.CACHE_DIR = tempfile.mkdtemp()
+    manager = WorldTextureManager()
+    manager.url = f'http://127.0.0.1:{server.server_port}/{{zoom}}/{{xtile}}/{{ytile}}.png'
+    manager.derived_policy = DerivedPolicy.NEVER
+    grid = [WorldTileIndex(manager, 10, 600 + i % 8, 400 + i // 8) for i in range(tiles)]
+
+    def load():
+        raster_cache.RasterCache._instance = raster_cache.RasterCache()  # a new session, nothing decoded in memory
+        sent.update(requests=0, bytes=0)
+        start = time.perf_counter()
+        assert all(raster is not None for _, raster in manager.load_tiles(grid))
+        return time.perf_counter() - start
+
+    full = load()
+    print(f'refetched in full: {full * 1000:.0f}ms until served, {sent["requests"]} requests, {sent["bytes"]} bytes')
+    raster_cache.DATA_EXPIRATION = 0  # everything cached is now expired
+    served = load()
+    cache = raster_cache.RasterCache.instance()
+    while cache.revalidating:
+        time.sleep(0.01)
+    print(f'stale while revalidate: {served * 1000:.0f}ms until served, {sent["requests"]} requests, '
+          f'{sent["bytes"]} bytes', cache.stats()['revalidation'])
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    _example_revalidation()
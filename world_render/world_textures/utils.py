@@ -14,4 +14,38 @@ def bbox_width(bbox: Tuple[float,float,float,float]):
     return bbox[2] - bbox[0]
 
 def bbox_height(bbox: Tuple[float,float,float,float]):
-    return bbox[3] - bbox[1]
\ No newline at end of file
+    return bbox[3] - bbox[1]
+
+def _spread_bits(value):
+    value = (value | (value << 16)) & 0x0000FFFF0000FFFF
+    value = (value | (value << 8)) & 0x00FF00FF00FF00FF
+    value = (value | (value << 4)) & 0x0F0F0F0F0F0F0F0F
+    value = (value | (value << 2)) & 0x3333333333333333
+    value = (value | (value << 1)) & 0x5555555555555555
+    return value
+
+
+def _compact_bits(value):
+    value &= 0x5555555555555555
+    value = (value | (value >> 1)) & 0x3333333333333333
+    value = (value | (value >> 2)) & 0x0F0F0F0F0F0F0F0F
+    value = (value | (value >> 4)) & 0x00FF00FF00FF00FF
+    value = (value | (value >> 8)) & 0x0000FFFF0000FFFF
+    value = (value | (value >> 16)) & 0x00000000FFFFFFFF
+    return value
+
+
+def morton_encode(x, y):
+    """Interleaves x in the even bits and y in the odd bits, works on ints and uint64 arrays alike"""
+    return _spread_bits(x) | (_spread_bits(y) << 1)
+
+
+def quadkey_encode(zoom: int, x: int, y: int) -> int:
+    """Morton interleave of x/y behind a leading 1 bit marking the zoom, unique over all zoom levels up to 31"""
+    return (1 << (2 * zoom)) | morton_encode(x, y)
+
+
+def quadkey_decode(quadkey: int) -> Tuple[int, int, int]:
+    zoom = (quadkey.bit_length() - 1) // 2
+    morton = quadkey ^ (1 << (2 * zoom))
+    return zoom, _compact_bits(morton), _compact_bits(morton >> 1)